@@ -0,0 +1,93 @@
+import json
+import time
+import argparse
+from collections import defaultdict
+
+import pandas as pd
+
+import loader
+from grangercausality import load_service, rank_columns_of_cluster, preferred_cluster, \
+    undirected_callgraph, count_tests, _compare_services
+from preprocess import INTERPOLATION_METHODS
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog='bench-granger', usage='%(prog)s [options]')
+    parser.add_argument('services_metadata', help='json file with callgraph')
+    parser.add_argument('measurements', nargs="+", help="measurement directories")
+    parser.add_argument('--selected', type=int, nargs="+", default=[1, 2, 3], help="metrics per cluster to compare with the full run")
+    parser.add_argument('--significance', type=float, default=0.05, help="p-value (lag 1) of an edge")
+    parser.add_argument('--sampling-rate', type=float, default=(1/2), help="how often data is updated per second")
+    parser.add_argument('--interpolation', choices=INTERPOLATION_METHODS, default="spline", help="how gaps are filled after aligning two services")
+    parser.add_argument('--output', help="write results as tsv to this file")
+    return parser.parse_args()
+
+def edges(df, significance):
+    """
+    metric edges like dependency_graph.collect_relations: of the two
+    directions of a metric pair exactly one is significant
+    """
+    p = {}
+    for row in df.itertuples():
+        p[(row.perpetrator_service, row.perpetrator_metric, row.consequence_service, row.consequence_metric)] = row.p_for_lag_1
+    found = set()
+    for (srv_a, a, srv_b, b), p_a in p.items():
+        p_b = p.get((srv_b, b, srv_a, a))
+        if p_b is None:
+            continue
+        if p_a <= significance and p_b > significance:
+            found.add((srv_a, a, srv_b, b))
+    return found
+
+def cluster_edges(metric_edges, clusters):
+    return set((srv_a, clusters[srv_a][a], srv_b, clusters[srv_b][b]) for srv_a, a, srv_b, b in metric_edges)
+
+def clusters_of(srv, path):
+    cluster = srv["clusters"][str(preferred_cluster(srv["clusters"]))]
+    ranked = rank_columns_of_cluster(cluster["filenames"], path)
+    return {c: i for i, columns in enumerate(ranked) for c in columns}
+
+def main():
+    args = parse_args()
+    call_pairs = undirected_callgraph(json.load(open(args.services_metadata))["edges"])
+    modes = [None] + args.selected
+    stats = defaultdict(list)
+    for path in args.measurements:
+        services = {srv["name"]: srv for srv in loader.metadata(path)["services"]}
+        clusters = {name: clusters_of(srv, path) for name, srv in services.items()}
+        for name_a, name_b in call_pairs:
+            full_edges = None
+            for selected in modes:
+                a = load_service(services[name_a], path, selected)
+                b = load_service(services[name_b], path, selected)
+                start = time.perf_counter()
+                df = _compare_services(a, b, path, args.sampling_rate, args.interpolation)
+                duration = time.perf_counter() - start
+                found = edges(df, args.significance)
+                if full_edges is None:
+                    full_edges = found
+                found_clusters = cluster_edges(found, clusters)
+                full_clusters = cluster_edges(full_edges, clusters)
+                common = len(found_clusters & full_clusters)
+                tests = count_tests(a.df.columns, b.df.columns)
+                stats["measurement"].append(path)
+                stats["services"].append("%s-%s" % (name_a, name_b))
+                stats["mode"].append("all" if selected is None else "selected-%d" % selected)
+                stats["tests"].append(tests)
+                stats["avoided_tests"].append(count_tests(a.all_metrics, b.all_metrics) - tests)
+                stats["time"].append(duration)
+                stats["metric_edges"].append(len(found))
+                stats["cluster_edges"].append(len(found_clusters))
+                stats["cluster_edge_recall"].append(common / max(1, len(full_clusters)))
+                stats["cluster_edge_precision"].append(common / max(1, len(found_clusters)))
+                # direction of the service edge: share of metric edges with b as perpetrator
+                perpetrator_b = sum(1 for e in found if e[0] == name_b)
+                stats["perpetrator_b_share"].append(perpetrator_b / max(1, len(found)))
+    df = pd.DataFrame(stats)
+    print(df.to_string())
+    columns = ["tests", "avoided_tests", "time", "cluster_edge_recall", "cluster_edge_precision"]
+    print(df.groupby("mode")[columns].mean().to_string())
+    if args.output is not None:
+        df.to_csv(args.output, sep="\t")
+
+if __name__ == '__main__':
+    main()
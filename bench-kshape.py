@@ -0,0 +1,227 @@
+import os
+import sys
+import time
+import tracemalloc
+import argparse
+from collections import defaultdict
+
+import pandas as pd
+import numpy as np
+from numpy.random import randint, seed
+
+import metadata
+import loader
+from sklearn.metrics import adjusted_rand_score
+
+from kshape import zscore, kshape, kshape_sweep, kshape_windowed, _ncc_c, _ncc_c_max, _series_fft, _extract_shape, _kshape, _inertia
+from cluster import service_chunks, silhouette_score
+import sbdcache
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog='bench-kshape', usage='%(prog)s [options]')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS), help="benchmark to run")
+    parser.add_argument('measurements', nargs="+", help="measurement directories")
+    parser.add_argument('--cluster-sizes', type=int, nargs="+", default=list(range(2, 8)), help="cluster sizes to benchmark")
+    parser.add_argument('--runs', type=int, default=5, help="seeded runs per configuration")
+    parser.add_argument('--window', type=int, default=1000, help="samples per window for the windowed k-shape")
+    parser.add_argument('--output', help="write results as tsv to this file")
+    return parser.parse_args()
+
+def load_series(path, service):
+    filename = os.path.join(path, service["preprocessed_filename"])
+    df = loader.preprocessed(filename)
+    return np.array([zscore(df[c]) for c in df.columns])
+
+def each_service(measurements):
+    for path in measurements:
+        for srv in loader.metadata(path)["services"]:
+            yield path, srv, load_series(path, srv)
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    res = func(*args, **kwargs)
+    return time.perf_counter() - start, res
+
+def _assign_pairwise(x, x_fft, centroids):
+    # assignment step as _kshape did it before the batched engine
+    distances = np.empty((x.shape[0], len(centroids)))
+    for i in range(x.shape[0]):
+        for j in range(len(centroids)):
+            distances[i, j] = 1 - max(_ncc_c(x[i], centroids[j]))
+    return distances.argmin(1)
+
+def _assign_batched(x, x_fft, centroids):
+    return (1 - _ncc_c_max(x, x_fft, centroids)).argmin(1)
+
+def bench_assign(args, stats):
+    for path, srv, x in each_service(args.measurements):
+        fft_time, x_fft = timed(_series_fft, x)
+        for k in args.cluster_sizes:
+            seed(k)
+            idx = randint(0, k, size=x.shape[0])
+            centroids = np.zeros((k, x.shape[1]))
+            for j in range(k):
+                centroids[j] = _extract_shape(idx, x, j, centroids[j])
+            pairwise_time, pairwise = timed(_assign_pairwise, x, x_fft, centroids)
+            batched_time, batched = timed(_assign_batched, x, x_fft, centroids)
+            stats["measurement"].append(path)
+            stats["service"].append(srv["name"])
+            stats["series"].append(x.shape[0])
+            stats["columns"].append(x.shape[1])
+            stats["cluster_size"].append(k)
+            stats["pairwise_time"].append(pairwise_time)
+            stats["batched_time"].append(batched_time + fft_time)
+            stats["speedup"].append(pairwise_time / (batched_time + fft_time))
+            stats["same_labels"].append(np.array_equal(pairwise, batched))
+
+def bench_init(args, stats):
+    for path, srv, x in each_service(args.measurements):
+        x_fft = _series_fft(x)
+        for k in args.cluster_sizes:
+            for init in ["random", "kshape++"]:
+                for run in range(args.runs):
+                    seed(run)
+                    trace = []
+                    duration, (idx, centroids) = timed(_kshape, x, k, x_fft=x_fft, init=init, trace=trace)
+                    stats["measurement"].append(path)
+                    stats["service"].append(srv["name"])
+                    stats["cluster_size"].append(k)
+                    stats["init"].append(init)
+                    stats["run"].append(run)
+                    stats["iterations"].append(len(trace))
+                    stats["extract_shape_calls"].append(sum(t["extract_shape"] for t in trace))
+                    stats["inertia"].append(_inertia(x, x_fft, idx, centroids))
+                    stats["time"].append(duration)
+
+def bench_extract(args, stats):
+    for path, srv, x in each_service(args.measurements):
+        for k in args.cluster_sizes:
+            seed(k)
+            idx = randint(0, k, size=x.shape[0])
+            for j in range(k):
+                cur_center = np.zeros(x.shape[1])
+                dense_time, dense = timed(_extract_shape, idx, x, j, cur_center, "dense")
+                eigsh_time, iterative = timed(_extract_shape, idx, x, j, cur_center, "eigsh")
+                stats["measurement"].append(path)
+                stats["service"].append(srv["name"])
+                stats["columns"].append(x.shape[1])
+                stats["cluster_size"].append(k)
+                stats["cluster"].append(j)
+                stats["members"].append((idx == j).sum())
+                stats["dense_time"].append(dense_time)
+                stats["eigsh_time"].append(eigsh_time)
+                stats["speedup"].append(dense_time / eigsh_time)
+                stats["max_abs_error"].append(np.abs(dense - iterative).max())
+
+def _labels(clusters, m):
+    labels = np.zeros(m, dtype=np.int64)
+    for i, (_, series) in enumerate(clusters):
+        labels[series] = i
+    return labels
+
+def bench_windowed(args, stats):
+    for path, srv, x in each_service(args.measurements):
+        x_fft = _series_fft(x)
+        distances = sbdcache.load(path, srv)
+        for k in args.cluster_sizes:
+            for run in range(args.runs):
+                results = {}
+                seed(run)
+                results["full"] = timed(kshape, x, k)
+                seed(run)
+                results["windowed"] = timed(kshape_windowed, service_chunks(path, srv, args.window), k)
+                stats["measurement"].append(path)
+                stats["service"].append(srv["name"])
+                stats["cluster_size"].append(k)
+                stats["run"].append(run)
+                for name, (duration, clusters) in results.items():
+                    centroids = np.array([centroid for centroid, _ in clusters])
+                    labels = _labels(clusters, x.shape[0])
+                    stats["%s_time" % name].append(duration)
+                    stats["%s_inertia" % name].append(_inertia(x, x_fft, labels, centroids))
+                    stats["%s_silhouette" % name].append(silhouette_score(x, clusters, distances))
+                stats["adjusted_rand_index"].append(adjusted_rand_score(_labels(results["full"][1], x.shape[0]),
+                                                                        _labels(results["windowed"][1], x.shape[0])))
+
+def summary_windowed(df):
+    return df.groupby(["service", "cluster_size"])[[c for c in df.columns if c.startswith(("full", "windowed", "adjusted"))]].mean()
+
+def bench_dtype(args, stats):
+    for path, srv, x in each_service(args.measurements):
+        for k in args.cluster_sizes:
+            for run in range(args.runs):
+                results = {}
+                for dtype in [np.float64, np.float32]:
+                    series = x.astype(dtype)
+                    tracemalloc.start()
+                    seed(run)
+                    results[dtype] = timed(kshape, series, k, dtype=dtype)
+                    _, peak = tracemalloc.get_traced_memory()
+                    tracemalloc.stop()
+                    name = np.dtype(dtype).name
+                    stats["%s_time" % name].append(results[dtype][0])
+                    stats["%s_peak_memory" % name].append(peak)
+                stats["measurement"].append(path)
+                stats["service"].append(srv["name"])
+                stats["cluster_size"].append(k)
+                stats["run"].append(run)
+                labels = [_labels(results[dtype][1], x.shape[0]) for dtype in [np.float64, np.float32]]
+                stats["same_labels"].append(np.array_equal(*labels))
+                stats["adjusted_rand_index"].append(adjusted_rand_score(*labels))
+
+def bench_sweep(args, stats):
+    for path, srv, x in each_service(args.measurements):
+        distances = sbdcache.load(path, srv)
+        for run in range(args.runs):
+            independent = {}
+            start = time.perf_counter()
+            for k in args.cluster_sizes:
+                seed(run)
+                independent[k] = kshape(x, k)
+            independent_time = time.perf_counter() - start
+            seed(run)
+            sweep_time, sweep = timed(lambda: dict(kshape_sweep(x, args.cluster_sizes)))
+            for k in args.cluster_sizes:
+                stats["measurement"].append(path)
+                stats["service"].append(srv["name"])
+                stats["run"].append(run)
+                stats["cluster_size"].append(k)
+                stats["independent_total_time"].append(independent_time)
+                stats["sweep_total_time"].append(sweep_time)
+                stats["independent_silhouette"].append(silhouette_score(x, independent[k], distances))
+                stats["sweep_silhouette"].append(silhouette_score(x, sweep[k], distances))
+
+def summary_sweep(df):
+    return df.groupby(["service", "cluster_size"])[[c for c in df.columns if c.startswith(("independent", "sweep"))]].mean()
+
+def summary_init(df):
+    return df.groupby(["service", "cluster_size", "init"])[["iterations", "extract_shape_calls", "inertia", "time"]].mean()
+
+BENCHMARKS = {
+    "assign": bench_assign,
+    "init": bench_init,
+    "extract": bench_extract,
+    "windowed": bench_windowed,
+    "dtype": bench_dtype,
+    "sweep": bench_sweep,
+}
+
+SUMMARIES = {
+    "init": summary_init,
+    "windowed": summary_windowed,
+    "sweep": summary_sweep,
+}
+
+def main():
+    args = parse_args()
+    stats = defaultdict(list)
+    BENCHMARKS[args.benchmark](args, stats)
+    df = pd.DataFrame(stats)
+    print(df.to_string())
+    if args.benchmark in SUMMARIES:
+        print(SUMMARIES[args.benchmark](df).to_string())
+    if args.output is not None:
+        df.to_csv(args.output, sep="\t")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from multiprocessing import Pool
+from collections import defaultdict
+
+import pandas as pd
+import numpy as np
+
+import metadata
+import metadatadb
+
+BACKENDS = ["json", "sqlite", "write-behind"]
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog='bench-metadata', usage='%(prog)s [options]')
+    parser.add_argument('measurements', nargs="+", help="measurement directories, only their metadata is used")
+    parser.add_argument('--workers', type=int, nargs="+", default=[1, 4, 16], help="numbers of concurrent workers")
+    parser.add_argument('--updates', type=int, default=50, help="metadata updates per worker")
+    parser.add_argument('--interval', type=float, default=1.0, help="flush interval of the write-behind backend in seconds")
+    parser.add_argument('--output', help="write results as tsv to this file")
+    return parser.parse_args()
+
+def _worker(args):
+    path, worker, updates, interval = args
+    if interval is not None:
+        metadata.write_behind(interval)
+    latencies = []
+    for i in range(updates):
+        start = time.perf_counter()
+        # the same kind of change as cluster.update_clusters
+        with metadata.update(path) as data:
+            srv = data["services"][(worker + i) % len(data["services"])]
+            clusters = srv.setdefault("clusters", {})
+            clusters["bench-%d" % worker] = dict(silhouette_score=float(i), filenames=[])
+        latencies.append(time.perf_counter() - start)
+    # pool workers are terminated, not left through atexit
+    metadata.flush()
+    return latencies
+
+def _lost_updates(path, workers, updates):
+    data = metadata.load(path)
+    found = set()
+    for srv in data["services"]:
+        for size, cluster in srv.get("clusters", {}).items():
+            if size.startswith("bench-") and cluster["silhouette_score"] == updates - 1:
+                found.add(size)
+    # every worker wrote its last update to one of the services
+    return workers - len(found)
+
+def bench(measurement, backend, workers, updates, interval):
+    path = tempfile.mkdtemp(prefix="bench-metadata-")
+    try:
+        shutil.copy(os.path.join(measurement, "metadata.json"), path)
+        if backend == "sqlite":
+            metadatadb.import_json(path)
+        start = time.perf_counter()
+        with Pool(workers) as pool:
+            if backend != "write-behind":
+                interval = None
+            latencies = pool.map(_worker, [(path, w, updates, interval) for w in range(workers)])
+        duration = time.perf_counter() - start
+        return duration, np.concatenate(latencies), _lost_updates(path, workers, updates)
+    finally:
+        shutil.rmtree(path)
+
+def main():
+    args = parse_args()
+    stats = defaultdict(list)
+    for measurement in args.measurements:
+        for workers in args.workers:
+            for backend in BACKENDS:
+                duration, latencies, lost = bench(measurement, backend, workers, args.updates, args.interval)
+                stats["measurement"].append(measurement)
+                stats["backend"].append(backend)
+                stats["workers"].append(workers)
+                stats["updates"].append(len(latencies))
+                stats["time"].append(duration)
+                stats["updates_per_second"].append(len(latencies) / duration)
+                stats["median_latency"].append(np.median(latencies))
+                stats["max_latency"].append(latencies.max())
+                stats["lost_updates"].append(lost)
+    df = pd.DataFrame(stats)
+    print(df.to_string())
+    if args.output is not None:
+        df.to_csv(args.output, sep="\t")
+
+if __name__ == '__main__':
+    main()
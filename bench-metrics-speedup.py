@@ -5,6 +5,7 @@ import subprocess
 import time
 import argparse
 import metadata
+import loader
 import os
 import json
 from plot import plt, sns
@@ -43,7 +44,7 @@ class Container():
         self.api.remove_container(container=self.id)
 
 def insert_influxdb(client, path, reduced_set=False):
-    m = metadata.load(path)
+    m = loader.metadata(path)
     for srv in m["services"]:
         if srv["name"] in ["loadgenerator"]:
             continue
@@ -0,0 +1,144 @@
+import os
+import sys
+import time
+import argparse
+import itertools
+from collections import defaultdict
+
+import pandas as pd
+import numpy as np
+from numpy.random import seed
+from sklearn.metrics import adjusted_rand_score
+
+import loader
+from kshape import zscore, kshape
+from preprocess import load_timeseries, classify_series, interpolate_missing, diff, INTERPOLATION_METHODS
+from cluster import zscore_matrix
+from grangercausality import Service, _compare_services
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog='bench-preprocess', usage='%(prog)s [options]')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS), help="benchmark to run")
+    parser.add_argument('measurements', nargs="+", help="measurement directories")
+    parser.add_argument('--sampling-rate', type=float, default=(1/2), help="how often data is updated per second")
+    parser.add_argument('--cluster-sizes', type=int, nargs="+", default=list(range(2, 7)), help="cluster sizes to compare")
+    parser.add_argument('--runs', type=int, default=3, help="seeded k-shape runs per cluster size")
+    parser.add_argument('--metrics', type=int, default=5, help="metrics per service in the granger comparison")
+    parser.add_argument('--output', help="write results as tsv to this file")
+    return parser.parse_args()
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    res = func(*args, **kwargs)
+    return time.perf_counter() - start, res
+
+def each_raw_service(measurements):
+    for path in measurements:
+        for srv in loader.metadata(path)["services"]:
+            df = load_timeseries(os.path.join(path, srv["filename"]), srv)
+            classes = classify_series(df)
+            yield path, srv, df[classes["other_fields"] + classes["monotonic_fields"]], classes["monotonic_fields"]
+
+def bench_interpolation(args, stats):
+    for path, srv, df, _ in each_raw_service(args.measurements):
+        results = {}
+        for method in INTERPOLATION_METHODS:
+            results[method] = timed(interpolate_missing, df, args.sampling_rate, method)
+        spline_time, spline = results["spline"]
+        for method, (duration, filled) in results.items():
+            stats["measurement"].append(path)
+            stats["service"].append(srv["name"])
+            stats["metrics"].append(len(df.columns))
+            stats["samples"].append(len(filled))
+            stats["method"].append(method)
+            stats["time"].append(duration)
+            stats["speedup"].append(spline_time / duration)
+            stats["max_difference"].append(np.abs(filled.values - spline.values).max())
+            stats["mean_difference"].append(np.abs(filled.values - spline.values).mean())
+
+def _labels(clusters, m):
+    labels = np.zeros(m, dtype=np.int64)
+    for i, (_, series) in enumerate(clusters):
+        labels[series] = i
+    return labels
+
+def bench_clusters(args, stats):
+    for path, srv, df, monotonic_fields in each_raw_service(args.measurements):
+        matrices = {}
+        for method in INTERPOLATION_METHODS:
+            matrices[method] = zscore_matrix(diff(interpolate_missing(df, args.sampling_rate, method), monotonic_fields))
+        x = matrices["spline"]
+        for k, run in itertools.product(args.cluster_sizes, range(args.runs)):
+            seed(run)
+            reference = _labels(kshape(x, k), x.shape[0])
+            for method in INTERPOLATION_METHODS:
+                seed(run)
+                labels = _labels(kshape(matrices[method], k), x.shape[0])
+                stats["measurement"].append(path)
+                stats["service"].append(srv["name"])
+                stats["cluster_size"].append(k)
+                stats["run"].append(run)
+                stats["method"].append(method)
+                stats["adjusted_rand_index"].append(adjusted_rand_score(reference, labels))
+
+def _zscored(df, metrics):
+    return pd.DataFrame({c: zscore(df[c]) for c in df.columns[:metrics]}, index=df.index)
+
+def bench_granger(args, stats):
+    for path in args.measurements:
+        services = []
+        for srv in loader.metadata(path)["services"]:
+            df = loader.preprocessed(os.path.join(path, srv["preprocessed_filename"]))
+            services.append(Service(srv["name"], [], _zscored(df, args.metrics)))
+        for a, b in itertools.combinations(services, 2):
+            results = {}
+            for method in INTERPOLATION_METHODS:
+                results[method] = timed(_compare_services, a, b, path, args.sampling_rate, method)
+            spline = results["spline"][1]
+            columns = [c for c in spline.columns if c.startswith("p_for_lag_")]
+            for method, (duration, res) in results.items():
+                same = res.merge(spline, on=["perpetrator_metric", "consequence_metric"], suffixes=("", "_spline"))
+                p = same[columns].values
+                p_spline = same[[c + "_spline" for c in columns]].values
+                stats["measurement"].append(path)
+                stats["services"].append("%s-%s" % (a.name, b.name))
+                stats["method"].append(method)
+                stats["tests"].append(len(same))
+                stats["time"].append(duration)
+                stats["max_p_difference"].append(np.abs(p - p_spline).max())
+                stats["median_p_difference"].append(np.median(np.abs(p - p_spline)))
+                stats["same_decision_at_0.05"].append(((p < 0.05) == (p_spline < 0.05)).mean())
+
+def summary_interpolation(df):
+    return df.groupby("method")[["time", "speedup", "mean_difference"]].mean()
+
+def summary_clusters(df):
+    return df.groupby(["method", "cluster_size"])["adjusted_rand_index"].mean().unstack()
+
+def summary_granger(df):
+    return df.groupby("method")[["time", "max_p_difference", "median_p_difference", "same_decision_at_0.05"]].mean()
+
+BENCHMARKS = {
+    "interpolation": bench_interpolation,
+    "clusters": bench_clusters,
+    "granger": bench_granger,
+}
+
+SUMMARIES = {
+    "interpolation": summary_interpolation,
+    "clusters": summary_clusters,
+    "granger": summary_granger,
+}
+
+def main():
+    args = parse_args()
+    stats = defaultdict(list)
+    BENCHMARKS[args.benchmark](args, stats)
+    df = pd.DataFrame(stats)
+    print(df.to_string())
+    print(SUMMARIES[args.benchmark](df).to_string())
+    if args.output is not None:
+        df.to_csv(args.output, sep="\t")
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,7 @@ from collections import defaultdict
 import numpy as np
 import pandas as pd
 import metadata
+import loader
 import sys, os
 
 def gap(centroids, data, labels, refs=None, nrefs=20, ks=range(1,11)):
@@ -48,7 +49,7 @@ def process_service(path, service_name, res):
       for j in range(i):
           name = "%s-cluster-%d_%d.tsv" % (service_name, i, j + 1)
           cluster_path = os.path.join(path, name)
-          df = pd.read_csv(cluster_path, sep="\t", index_col='time', parse_dates=True)
+          df = loader.read(cluster_path)
           centroids.append(df.columns[0])
           for idx, c in enumerate(df.columns[1:]):
               metrics.append(df[c])
@@ -76,7 +77,7 @@ def process_service(path, service_name, res):
   res["best_cluster"].append(best + 2)
 
 def main(path):
-    data = metadata.load(path)
+    data = loader.metadata(path)
     result = defaultdict(list)
     for srv in data["services"]:
         process_service(path, srv["name"], result)
@@ -1,6 +1,8 @@
 import os
 import sys
+import gzip
 import json
+import argparse
 
 import pandas as pd
 import numpy as np
@@ -8,15 +10,17 @@ from sklearn.metrics import silhouette_score as _silhouette_score
 from metricsnamecluster import cluster_words
 
 import graphs
-from kshape import kshape, zscore, _sbd
+from kshape import kshape, kshape_sweep, kshape_windowed, zscore, sbd_distances, _window_stats
 import metadata
+import sbdcache
+import store
+import loader
+from preprocess import write_tsv
 
-def silhouette_score(series, clusters):
-    distances = np.zeros((series.shape[0], series.shape[0]))
-    for idx_a, metric_a in enumerate(series):
-        for idx_b, metric_b in enumerate(series):
-            distances[idx_a, idx_b] = _sbd(metric_a, metric_b)[0]
-    labels = np.zeros(series.shape[0])
+def silhouette_score(series, clusters, distances=None):
+    if distances is None:
+        distances = sbd_distances(series)
+    labels = np.zeros(len(distances))
     for i, (cluster, indicies) in enumerate(clusters):
         for index in indicies:
             labels[index] = i
@@ -26,13 +30,33 @@ def silhouette_score(series, clusters):
     else:
         return _silhouette_score(distances, labels, metric='precomputed')
 
-def do_kshape(name_prefix, df, cluster_size, initial_clustering=None):
+def zscore_matrix(df, dtype=np.float64):
+    matrix = np.empty((len(df.columns), len(df)), dtype=dtype)
+    for i, c in enumerate(df.columns):
+        matrix[i] = zscore(df[c])
+    return matrix
+
+def do_kshape(name_prefix, df, cluster_size, initial_clustering=None, distances=None, n_init=1, n_jobs=1, init="random", dtype=np.float64,
+               tol=0.0, write_trace=False):
+    columns = df.columns
+    matrix = zscore_matrix(df, dtype)
+    trace = []
+    res = kshape(matrix, cluster_size, initial_clustering, n_init=n_init, n_jobs=n_jobs, init=init, trace=trace, dtype=dtype, tol=tol)
+    print_trace(name_prefix, trace)
+    if write_trace:
+        pd.DataFrame(trace).to_csv(name_prefix + "-trace.tsv", sep="\t", index=False)
+    score = silhouette_score(matrix, res, distances)
+    return score, write_clusters(name_prefix, df, matrix, res)
+
+def print_trace(name_prefix, trace):
+    extract_time = sum(t["extract_time"] for t in trace)
+    assign_time = sum(t["assign_time"] for t in trace)
+    cycle = " (cycle)" if trace[-1]["cycle"] else ""
+    print("%s: %d iterations%s, %.2fs shape extraction, %.2fs assignment, inertia %f" %
+          (name_prefix, len(trace), cycle, extract_time, assign_time, trace[-1]["inertia"]))
+
+def write_clusters(name_prefix, df, matrix, res):
     columns = df.columns
-    matrix = []
-    for c in columns:
-        matrix.append(zscore(df[c]))
-    res = kshape(matrix, cluster_size, initial_clustering)
-    score = silhouette_score(np.array(matrix), res)
     filenames = []
     for i, (centroid, assigned_series) in enumerate(res):
         d = {}
@@ -48,39 +72,234 @@ def do_kshape(name_prefix, df, cluster_size, initial_clustering=None):
         df2.to_csv(filename, sep="\t", compression='gzip')
         filenames.append(os.path.basename(filename))
         graphs.write(df2, name + ".png")
-    return score, filenames
+    return filenames
+
+def load_service(path, service):
+    filename = os.path.join(path, service["preprocessed_filename"])
+    return loader.preprocessed(filename)
+
+def service_frames(path, service, chunksize):
+    """
+    preprocessed metrics of a service as time indexed frames of chunksize samples
+    """
+    filename = os.path.join(path, service["preprocessed_filename"])
+    if store.exists(filename):
+        matrix, index, columns = store.read_matrix(filename)
+        for start in range(0, len(matrix), chunksize):
+            yield pd.DataFrame(np.array(matrix[start:start + chunksize]),
+                               index=index[start:start + chunksize], columns=columns)
+        return
+    yield from pd.read_csv(filename, sep="\t", index_col='time', parse_dates=True, chunksize=chunksize)
+
+def service_chunks(path, service, chunksize):
+    """
+    source for kshape_windowed: reads the preprocessed metrics of a service
+    in windows of chunksize samples, one row per metric
+    """
+    return lambda: (df.values.T for df in service_frames(path, service, chunksize))
+
+def window_distances(chunks):
+    """
+    shape based distances of the series of chunks (see kshape_windowed) for
+    silhouette_score without loading them at once: the distances within
+    every window, weighted by its length. Series are z-scored over the whole
+    measurement like in kshape_windowed.
+    """
+    mean, std = _window_stats(chunks)
+    std[std == 0] = np.inf
+    total, length = 0, 0
+    for chunk in chunks():
+        z = (np.asarray(chunk, dtype=np.float64) - mean[:, np.newaxis]) / std[:, np.newaxis]
+        total = total + sbd_distances(z) * z.shape[1]
+        length += z.shape[1]
+    return total / length
+
+# samples per series in the graphs of windowed clusters
+PLOT_SAMPLES = 10000
+
+def write_clusters_windowed(name_prefix, path, service, window, res):
+    """
+    like write_clusters, but the z-scored series are written window by
+    window. The graphs only show every n-th sample, at most PLOT_SAMPLES.
+    """
+    chunks = service_chunks(path, service, window)
+    mean, std = _window_stats(chunks)
+    std[std == 0] = np.inf
+    length = len(res[0][0])
+    step = max(1, -(-length // PLOT_SAMPLES))
+    names = ["%s_%d" % (name_prefix, i + 1) for i in range(len(res))]
+    outs = [gzip.open(name + ".tsv.gz", "wt") for name in names]
+    plots = [[] for _ in res]
+    try:
+        row = 0
+        for df in service_frames(path, service, window):
+            z = (df.values - mean) / std
+            columns = df.columns
+            for out, plot, (centroid, assigned_series) in zip(outs, plots, res):
+                d = {}
+                for serie in assigned_series:
+                    d[columns[serie]] = z[:, serie]
+                d["centroid"] = centroid[row:row + len(df)]
+                df2 = pd.DataFrame(d, index=df.index)
+                write_tsv(df2, out, header=row == 0)
+                plot.append(df2.iloc[(-row) % step::step])
+            row += len(df)
+    finally:
+        for out in outs:
+            out.close()
+    filenames = []
+    for name, plot in zip(names, plots):
+        print(name + ".tsv.gz")
+        filenames.append(os.path.basename(name + ".tsv.gz"))
+        graphs.write(pd.concat(plot), name + ".png")
+    return filenames
 
-def cluster_service(path, service, cluster_size):
+def cluster_service(path, service, cluster_size, distances=None, n_init=1, n_jobs=1, init="random", dtype=np.float64,
+                    tol=0.0, write_trace=False):
     prefix = "%s/%s-cluster-%d" % (path, service["name"], cluster_size)
     if os.path.exists(prefix + "_1.png"):
         print("skip " + prefix)
         return
-    filename = os.path.join(path, service["preprocessed_filename"])
-    df = pd.read_csv(filename, sep="\t", index_col='time', parse_dates=True)
+    df = load_service(path, service)
+    if distances is None:
+        distances = sbdcache.load(path, service, list(df.columns))
     # TODO initial clustering based word cluster
     #clustering = cluster_words(df.columns, service["name"], cluster_size)
     #assignment = np.zeros(len(df.columns))
     #for cluster, elements in enumerate(clustering):
     #    for element in elements:
     #        assignment[element] = cluster
-    score, filenames = do_kshape(prefix, df, cluster_size, initial_clustering=None)
+    score, filenames = do_kshape(prefix, df, cluster_size,
+                                 initial_clustering=None,
+                                 distances=distances,
+                                 n_init=n_init,
+                                 n_jobs=n_jobs,
+                                 init=init,
+                                 dtype=dtype,
+                                 tol=tol,
+                                 write_trace=write_trace)
+    if cluster_size < 2:
+        # no silhouette_score for cluster size 1
+        return
+    print("silhouette_score: %f" % score)
+    update_clusters(path, service, {cluster_size: (score, filenames)})
+
+def cluster_service_windowed(path, service, cluster_size, window, distances=None, dtype=np.float64,
+                             tol=0.0, write_trace=False):
+    """
+    like cluster_service for services too long to keep in memory: k-shape,
+    the silhouette score and the cluster files read the series in windows
+    of window samples (see kshape_windowed and window_distances)
+    """
+    prefix = "%s/%s-cluster-%d" % (path, service["name"], cluster_size)
+    if os.path.exists(prefix + "_1.png"):
+        print("skip " + prefix)
+        return
+    chunks = service_chunks(path, service, window)
+    trace = []
+    res = kshape_windowed(chunks, cluster_size, tol=tol, trace=trace, dtype=dtype)
+    print_trace(prefix, trace)
+    if write_trace:
+        pd.DataFrame(trace).to_csv(prefix + "-trace.tsv", sep="\t", index=False)
+    if distances is None:
+        distances = window_distances(chunks)
+    score = silhouette_score(None, res, distances)
+    filenames = write_clusters_windowed(prefix, path, service, window, res)
     if cluster_size < 2:
         # no silhouette_score for cluster size 1
         return
     print("silhouette_score: %f" % score)
+    update_clusters(path, service, {cluster_size: (score, filenames)})
+
+def update_clusters(path, service, results):
     with metadata.update(path) as data:
         for srv in data["services"]:
             if srv["name"] == service["name"]:
                 if "clusters" not in srv:
                     srv["clusters"] = {}
-                d = dict(silhouette_score=score, filenames=filenames)
-                srv["clusters"][cluster_size] = d
+                for cluster_size, (score, filenames) in results.items():
+                    d = dict(silhouette_score=score, filenames=filenames)
+                    srv["clusters"][cluster_size] = d
+
+def cluster_service_sweep(path, service, cluster_sizes, init="random", dtype=np.float64, tol=0.0, write_trace=False):
+    """
+    like cluster_service for all cluster_sizes at once: the data is loaded and
+    z-scored once and every cluster size is warm started from the previous
+    one (see kshape_sweep). Writes the same files and metadata.
+    """
+    prefixes = {}
+    for cluster_size in cluster_sizes:
+        prefix = "%s/%s-cluster-%d" % (path, service["name"], cluster_size)
+        if os.path.exists(prefix + "_1.png"):
+            print("skip " + prefix)
+        else:
+            prefixes[cluster_size] = prefix
+    if len(prefixes) == 0:
+        return
+    df = load_service(path, service)
+    matrix = zscore_matrix(df, dtype)
+    distances = sbdcache.load(path, service, list(df.columns))
+    # smaller sizes are still needed as starting points of the larger ones
+    sizes = [n for n in cluster_sizes if n <= max(prefixes)]
+    trace = []
+    for cluster_size, res in kshape_sweep(matrix, sizes, init=init, dtype=dtype, tol=tol, trace=trace):
+        if cluster_size not in prefixes:
+            continue
+        steps = [entry for entry in trace if entry["cluster_size"] == cluster_size]
+        print_trace(prefixes[cluster_size], steps)
+        if write_trace:
+            pd.DataFrame(steps).to_csv(prefixes[cluster_size] + "-trace.tsv", sep="\t", index=False)
+        score = silhouette_score(matrix, res, distances)
+        filenames = write_clusters(prefixes[cluster_size], df, matrix, res)
+        if cluster_size < 2:
+            # no silhouette_score for cluster size 1
+            continue
+        print("%s silhouette_score: %f" % (prefixes[cluster_size], score))
+        # record every size as soon as its files exist, so an interrupted
+        # sweep is not skipped next time with the metadata missing
+        update_clusters(path, service, {cluster_size: (score, filenames)})
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog='cluster', usage='%(prog)s [options]')
+    parser.add_argument('measurement', help="measurement directory")
+    parser.add_argument('--n-init', type=int, default=1, help="number of k-shape restarts per cluster size, the best one is kept")
+    parser.add_argument('--jobs', type=int, default=1, help="number of processes for the restarts")
+    parser.add_argument('--init', choices=["random", "kshape++"], default="random", help="initialization of k-shape")
+    parser.add_argument('--dtype', choices=["float64", "float32"], default="float64", help="precision of the k-shape computation")
+    parser.add_argument('--sweep', action='store_true', help="warm start each cluster size from the previous one")
+    parser.add_argument('--tol', type=float, default=0.0, help="stop k-shape if at most this fraction of assignments changes")
+    parser.add_argument('--trace', action='store_true', help="write per iteration timings of k-shape to <cluster>-trace.tsv")
+    parser.add_argument('--window', type=int, metavar="N", help="run k-shape on windows of N samples at a time (kshape_windowed) to bound its memory, ignores --n-init, --jobs and --init")
+    args = parser.parse_args()
+    if args.window is not None and args.sweep:
+        parser.error("--window cannot be combined with --sweep")
+    if args.sweep and (args.n_init != 1 or args.jobs != 1):
+        parser.error("--sweep warm starts every size once and cannot be combined with --n-init or --jobs")
+    return args
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        sys.stderr.write("USAGE: %s measurement\n" % sys.argv[0])
-        sys.exit(1)
-    path = sys.argv[1]
-    for n in range(2, 7):
-        for srv in metadata.load(path)["services"]:
-            cluster_service(path, srv, n)
+    args = parse_args()
+    path = args.measurement
+    for srv in loader.metadata(path)["services"]:
+        if args.sweep:
+            cluster_service_sweep(path, srv, range(2, 7), init=args.init, dtype=np.dtype(args.dtype),
+                                  tol=args.tol, write_trace=args.trace)
+            continue
+        if args.window is not None:
+            distances = window_distances(service_chunks(path, srv, args.window))
+            for n in range(2, 7):
+                cluster_service_windowed(path, srv, n, args.window, distances,
+                                         dtype=np.dtype(args.dtype),
+                                         tol=args.tol,
+                                         write_trace=args.trace)
+            continue
+        # the distance matrix is the same for all cluster sizes
+        distances = sbdcache.load(path, srv)
+        for n in range(2, 7):
+            cluster_service(path, srv, n, distances,
+                            n_init=args.n_init,
+                            n_jobs=args.jobs,
+                            init=args.init,
+                            dtype=np.dtype(args.dtype),
+                            tol=args.tol,
+                            write_trace=args.trace)
@@ -4,6 +4,7 @@ import argparse
 import numpy as np
 from collections import defaultdict, OrderedDict
 import metadata
+import loader
 import os
 from sklearn import metrics
 
@@ -27,7 +28,7 @@ SERVICE_TABLE = {
 def load_cluster_assignments(measurements):
     all_measurements = defaultdict(list)
     for m in measurements:
-        data = metadata.load(m)
+        data = loader.metadata(m)
         for srv in data["services"]:
             if srv["name"] == "loadgenerator": continue
             assignment = OrderedDict()
@@ -37,9 +38,8 @@ def load_cluster_assignments(measurements):
                 all_clusters = []
                 all_columns = []
                 for idx, f in enumerate(c["filenames"]):
-                    df = pd.read_csv(os.path.join(m, f), sep="\t")
+                    df = loader.read(os.path.join(m, f))
                     columns = list(df.columns)
-                    columns.remove("time")
                     columns.remove("centroid")
                     all_clusters.extend([idx] * len(columns))
                     all_columns.extend(columns)
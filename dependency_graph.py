@@ -10,10 +10,12 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 EXCLUDE = []
+# grangercausality --selected N writes *-causality-callgraph-selected-N.tsv.gz
+CAUSALITY_FILES = "*-causality-callgraph-best.tsv.gz"
 
 def each_relation(paths):
     for path in paths:
-        for tsv in sorted(glob.glob(os.path.join(path, "*-causality-callgraph-best.tsv.gz"))):
+        for tsv in sorted(glob.glob(os.path.join(path, CAUSALITY_FILES))):
             df = pd.read_csv(tsv, sep="\t")
             if len(df) == 0:
                 continue
@@ -181,12 +183,15 @@ def parse_args():
     parser = argparse.ArgumentParser(prog='PROG', usage='%(prog)s [options]')
     parser.add_argument('--format', nargs="?", default="dot", choices=['json', 'dot', 'table'])
     parser.add_argument('--significance', type=float, default=0.10)
+    parser.add_argument('--selected', type=int, metavar="N", help="use the results of grangercausality --selected N")
     parser.add_argument('output_file', help='graph file to write')
     parser.add_argument('measurements', nargs="+", help="measurement directory with granger causality files")
     return parser.parse_args()
 
 if __name__ == "__main__":
     args = parse_args()
+    if args.selected is not None:
+        CAUSALITY_FILES = "*-causality-callgraph-selected-%d.tsv.gz" % args.selected
     if args.format == "json":
         func = write_json
     elif args.format == "table":
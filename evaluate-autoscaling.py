@@ -3,6 +3,7 @@ import pandas as pd
 import argparse
 import numpy as np
 import metadata
+import loader
 import os
 from collections import defaultdict
 
@@ -24,7 +25,7 @@ def parse_args():
     return parser.parse_args()
 
 def load_metrics(measurement):
-    data = metadata.load(measurement)
+    data = loader.metadata(measurement)
     stats = defaultdict(list)
     for srv in data["services"]:
         df = pd.read_csv(os.path.join(measurement, srv["filename"]),
@@ -3,6 +3,7 @@ import sys
 import re
 import numpy as np
 import metadata
+import loader
 import pandas as pd
 from kshape import _sbd
 
@@ -29,7 +30,7 @@ def best_column_of_cluster(filenames, path):
         best_distance = np.inf
         best_column = None
         cluster_path = os.path.join(path, filename)
-        df = pd.read_csv(cluster_path, sep="\t", index_col='time', parse_dates=True)
+        df = loader.read(cluster_path)
         for c in df.columns:
             if c == "centroid":
                 continue
@@ -45,7 +46,7 @@ def best_column_of_cluster(filenames, path):
 
 if __name__ == "__main__":
     for path in sys.argv[1:]:
-        data = metadata.load(path)
+        data = loader.metadata(path)
         edge = []
         name = []
         is_diff = []
@@ -2,21 +2,28 @@ import os
 import sys
 import json
 import math
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import itertools
 import re
+import time
 import argparse
 import fnmatch
+import hashlib
+import traceback
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 import pandas as pd
 import numpy as np
-from statsmodels.tsa.stattools import grangercausalitytests, adfuller
-from scipy.stats import linregress
+from statsmodels.tsa.stattools import adfuller
+from scipy.stats import linregress, f as f_distribution
 
 import metadata
-from kshape import zscore, _sbd
+import metadatadb
+import loader
+from kshape import zscore, _sbd, _share
 
-from preprocess import interpolate_missing
+from preprocess import interpolate_missing, INTERPOLATION_METHODS
 
 def preferred_cluster(clusters):
     preferred = 0
@@ -32,56 +39,241 @@ def natural_sort(l):
     alphanum_key = lambda key: [ convert(c) for c in re.split('([0-9]+)', key) ]
     return sorted(l, key = alphanum_key)
 
-def best_column_of_cluster(filenames, path):
-    best_column_of_clusters = []
-    index = None
+def rank_columns_of_cluster(filenames, path):
+    """
+    the columns of each cluster file, closest to the centroid first
+    """
+    ranked = []
     for filename in natural_sort(filenames):
-        best_distance = np.inf
-        best_column = None
         cluster_path = os.path.join(path, filename)
-        df = pd.read_csv(cluster_path, sep="\t", index_col='time', parse_dates=True)
-        for c in df.columns:
+        df = loader.read(cluster_path)
+        distances = []
+        for i, c in enumerate(df.columns):
             if c == "centroid":
                 continue
             distance = _sbd(df.centroid, df[c])[0]
-            if distance < best_distance:
-                best_distance = distance
-                best_column = c
-        best_column_of_clusters.append(best_column)
-    return best_column_of_clusters
-
-def read_service(srv, path):
-    srv_path = os.path.join(path, srv["preprocessed_filename"])
-    df = pd.read_csv(srv_path, sep="\t", index_col='time', parse_dates=True)
-    for c in df.columns:
-        df[c] = zscore(df[c])
+            if distance < np.inf:
+                distances.append((distance, i, c))
+        ranked.append([c for _, _, c in sorted(distances)])
+    return ranked
 
+def best_column_of_cluster(filenames, path):
+    return [columns[0] if len(columns) > 0 else None
+            for columns in rank_columns_of_cluster(filenames, path)]
+
+def load_service(srv, path, selected=None):
+    """
+    z-scored metrics of a service and the metrics selected by its preferred
+    clustering, without recording them (see record_selected_metrics). With
+    selected = N, only the N metrics closest to the centroid of each cluster
+    are loaded.
+    """
     preferred = preferred_cluster(srv["clusters"])
     cluster = srv["clusters"][str(preferred)]
-    selected_metrics = best_column_of_cluster(cluster["filenames"], path)
+    ranked = rank_columns_of_cluster(cluster["filenames"], path)
+    selected_metrics = [columns[0] if len(columns) > 0 else None for columns in ranked]
+
+    srv_path = os.path.join(path, srv["preprocessed_filename"])
+    # the loaded frame is shared, the z-scored one is a new frame
+    df = loader.preprocessed(srv_path)
+    all_metrics = list(df.columns)
+    if selected is not None:
+        tested = set(c for columns in ranked for c in columns[:selected])
+        df = df[[c for c in df.columns if c in tested]]
+    df = pd.DataFrame({c: zscore(df[c]) for c in df.columns}, index=df.index, columns=df.columns)
+    return Service(srv["name"], selected_metrics, df, preferred, all_metrics)
+
+def count_tests(columns_a, columns_b):
+    """
+    granger causality tests of _compare_services, both directions of each pair
+    """
+    return 2 * (len(columns_a) * len(columns_b) - len(set(columns_a) & set(columns_b)))
+
+def record_selected_metrics(path, services):
+    """
+    store the selected metrics of loaded services in the metadata, in one update
+    """
+    by_name = {service.name: service for service in services}
+    if len(by_name) == 0:
+        return
     with metadata.update(path) as data:
         for s in data["services"]:
-            if s["name"] == srv["name"]:
-                s["clusters"][str(preferred)]["grangercausality-metrics"] = selected_metrics
+            if s["name"] in by_name:
+                service = by_name[s["name"]]
+                s["clusters"][str(service.cluster_size)]["grangercausality-metrics"] = service.cluster_metrics
 
-    return Service(srv["name"], selected_metrics, df)
-
-def grangercausality(service_a, service_b, df, stats, lags):
+def read_service(srv, path):
+    service = load_service(srv, path)
+    record_selected_metrics(path, [service])
+    return service
+
+# restricted models by (digest of the target series, lag), see _restricted
+RESTRICTED_CACHE_BYTES = 256 * 2**20
+_restricted_cache = OrderedDict()
+_restricted_cache_bytes = 0
+
+def _lags(values, lag):
+    """
+    the last n - lag rows of values and their lags 1..lag,
+    shapes (n - lag, columns) and (n - lag, columns, lag)
+    """
+    n = values.shape[0]
+    lagged = np.stack([values[lag - i:n - i] for i in range(1, lag + 1)], axis=-1)
+    return values[lag:], lagged
+
+def _lstsq_ssr(x, y):
+    # like the pinv solution of statsmodels, also for rank deficient designs
+    beta, _, rank, _ = np.linalg.lstsq(x, y, rcond=None)
+    residual = y - x @ beta
+    return residual @ residual, rank
+
+def _full_rank(r, norms, rtol=1e-8):
+    # the diagonal of r is the part of each column not explained by the previous ones
+    diag = np.abs(np.diagonal(r, axis1=-2, axis2=-1))
+    return diag > rtol * np.maximum(norms, 1e-300)
+
+def _digest(values):
+    return hashlib.blake2b(np.ascontiguousarray(values).tobytes(), digest_size=16).digest()
+
+def _nbytes(entry):
+    return sum(a.nbytes for a in entry[:2] if a is not None)
+
+def _restricted(y, y_lags, key):
+    """
+    restricted model of a target, its own lags and a constant like
+    grangercausalitytests: q of its QR factorization and the residual (both
+    None if the design is rank deficient) and the ssr. It does not depend on
+    the source and is cached by key, the target's digest and the lag.
+    """
+    global _restricted_cache_bytes
+    entry = _restricted_cache.get(key)
+    if entry is not None:
+        _restricted_cache.move_to_end(key)
+        return entry
+    restricted = np.hstack([y_lags, np.ones((len(y), 1))])
+    q, r = np.linalg.qr(restricted)
+    if _full_rank(r, np.linalg.norm(restricted, axis=0)).all():
+        residual = y - q @ (q.T @ y)
+        entry = (q, residual, residual @ residual)
+    else:
+        entry = (None, None, _lstsq_ssr(restricted, y)[0])
+    _restricted_cache[key] = entry
+    _restricted_cache_bytes += _nbytes(entry)
+    while _restricted_cache_bytes > RESTRICTED_CACHE_BYTES:
+        _, old = _restricted_cache.popitem(last=False)
+        _restricted_cache_bytes -= _nbytes(old)
+    return entry
+
+def _ssr_ftest(targets, sources, lag, digests):
+    y, y_lags = _lags(targets, lag)
+    _, x_lags = _lags(sources, lag)
+    nobs = y.shape[0]
+    # the source lags of all sources as the columns of one matrix
+    z = x_lags.reshape(nobs, -1)
+    norms = np.linalg.norm(x_lags, axis=0)
+    p = np.empty((targets.shape[1], sources.shape[1]))
+    for t in range(targets.shape[1]):
+        q, residual, ssr_restricted = _restricted(y[:, t], y_lags[:, t], (digests[t], lag))
+        if q is None:
+            p[t] = _ssr_ftest_lstsq(y[:, t], y_lags[:, t], ssr_restricted, x_lags, lag)
+            continue
+        # the unrestricted model adds the source lags: what they explain of the
+        # residual is its projection onto their part orthogonal to the restricted design
+        orthogonal = z - q @ (q.T @ z)
+        orthogonal = orthogonal.reshape(nobs, -1, lag).transpose(1, 0, 2)
+        qs, rs = np.linalg.qr(orthogonal)
+        explained = (np.einsum("snl,n->sl", qs, residual) ** 2).sum(axis=1)
+        df_resid = nobs - 2 * lag - 1
+        fvalue = explained / (ssr_restricted - explained) / lag * df_resid
+        p[t] = f_distribution.sf(fvalue, lag, df_resid)
+        deficient = ~_full_rank(rs, norms).all(axis=1)
+        if deficient.any():
+            p[t, deficient] = _ssr_ftest_lstsq(y[:, t], y_lags[:, t], ssr_restricted, x_lags[:, deficient], lag)
+    return p
+
+def _ssr_ftest_lstsq(y, y_lags, ssr_restricted, x_lags, lag):
+    p = np.empty(x_lags.shape[1])
+    ones = np.ones((len(y), 1))
+    for s in range(x_lags.shape[1]):
+        unrestricted = np.hstack([y_lags, x_lags[:, s], ones])
+        ssr, rank = _lstsq_ssr(unrestricted, y)
+        df_resid = len(y) - rank
+        with np.errstate(divide="ignore", invalid="ignore"):
+            fvalue = (ssr_restricted - ssr) / ssr / lag * df_resid
+        p[s] = f_distribution.sf(fvalue, lag, df_resid)
+    return p
+
+def _testable(values):
+    with np.errstate(invalid="ignore"):
+        return np.isfinite(values).all(axis=0) & (np.ptp(values, axis=0) > 0)
+
+def ssr_ftest(targets, sources, lags):
+    """
+    p-values of the ssr based F test of statsmodels' grangercausalitytests
+    whether a source column granger-causes a target column, for every
+    target/source pair and lag 1..lags: shape (lags, targets, sources).
+    Pairs with missing values or a constant series, which statsmodels
+    rejects, get nan.
+
+    >>> import warnings
+    >>> from statsmodels.tsa.stattools import grangercausalitytests
+    >>> rng = np.random.RandomState(0)
+    >>> s = rng.randn(200)
+    >>> t = np.roll(s, 2) + 0.5 * rng.randn(200)
+    >>> p = ssr_ftest(np.column_stack([t, np.ones(200)]), np.column_stack([s, t]), 3)
+    >>> def reference(target, source):
+    ...     with warnings.catch_warnings():
+    ...         warnings.simplefilter("ignore")
+    ...         res = grangercausalitytests(np.column_stack([target, source]), 3)
+    ...     return [res[lag][0]["ssr_ftest"][1] for lag in [1, 2, 3]]
+    >>> np.allclose(p[:, 0, 0], reference(t, s), rtol=1e-6, atol=0)
+    True
+    >>> # the source is the target itself: rank deficient, solved by lstsq
+    >>> np.allclose(p[:, 0, 1], reference(t, t), rtol=1e-6, atol=0)
+    True
+    >>> bool(np.isnan(p[:, 1, :]).all())
+    True
+    """
+    targets = np.asarray(targets, dtype=np.float64)
+    sources = np.asarray(sources, dtype=np.float64)
+    if targets.shape[0] <= 3 * lags + 1:
+        raise ValueError("Insufficient observations. Maximum allowable lag is %d" %
+                         int((targets.shape[0] - 2) / 3))
+    p = np.full((lags, targets.shape[1], sources.shape[1]), np.nan)
+    t = np.flatnonzero(_testable(targets))
+    s = np.flatnonzero(_testable(sources))
+    if len(t) == 0 or len(s) == 0:
+        return p
+    # a metric has the same series in all pairs of its service if the services
+    # share their timestamps, its restricted models are computed once
+    digests = [_digest(targets[:, i]) for i in t]
+    for lag in range(1, lags + 1):
+        p[np.ix_([lag - 1], t, s)] = _ssr_ftest(targets[:, t], sources[:, s], lag, digests)
+    return p
+
+def _trend(df, c, trends):
+    if c not in trends:
+        trends[c] = linregress(df[c].index.astype("int64"), df[c])
+    return trends[c]
+
+def grangercausality(service_a, service_b, df, stats, p_values, trends):
+    """
+    add the granger causality of df's second column to its first, p_values
+    are the results of ssr_ftest for this pair
+    """
     c1 = df.columns[0]
     c2 = df.columns[1]
-    try:
-        res = grangercausalitytests(df, lags, verbose=False)
-    except Exception as e:
+    if not np.isfinite(p_values).all():
         if df[c1].var() < 1e-30:
-            print("low variance for %s, got: %s" % (c1, e))
+            print("low variance for %s" % c1)
         if df[c2].var() < 1e-30:
-            print("low variance for %s, got: %s" % (c2, e))
+            print("low variance for %s" % c2)
         else:
-            print("error while processing %s -> %s, got: %s" % (c1, c2, e))
+            print("error while processing %s -> %s, got no p-value" % (c1, c2))
         return
     reg = linregress(df[c1], df[c2])
-    reg_a = linregress(df[c1].index.astype("int64"), df[c1])
-    reg_b = linregress(df[c2].index.astype("int64"), df[c2])
+    reg_a = _trend(df, c1, trends)
+    reg_b = _trend(df, c2, trends)
 
     stats["perpetrator_service"].append(service_a.name)
     stats["perpetrator_metric"].append(c1)
@@ -97,9 +289,8 @@ def grangercausality(service_a, service_b, df, stats, lags):
     for i, type in enumerate(["slope", "intercept", "r_value", "p_value", "std_err"]):
         stats[type].append(reg[i])
 
-    for i in range(lags):
-        lag = i + 1
-        stats["p_for_lag_%d" % lag].append(res[lag][0]['ssr_ftest'][1])
+    for i, p in enumerate(p_values):
+        stats["p_for_lag_%d" % (i + 1)].append(p)
 
 def combine(a, b):
     for x in a:
@@ -107,20 +298,35 @@ def combine(a, b):
             yield(x,y)
 
 class Service():
-    def __init__(self, name, selected_metrics, df):
+    def __init__(self, name, selected_metrics, df, cluster_size=None, all_metrics=None):
         self.name = name
         self.selected_metrics = set(selected_metrics)
         self.df = df
+        # the clustering the selected metrics come from, one metric per cluster
+        self.cluster_size = cluster_size
+        self.cluster_metrics = list(selected_metrics)
+        # metrics of the service, df may only contain some of them
+        self.all_metrics = list(df.columns) if all_metrics is None else all_metrics
 
-def _compare_services(service_a, service_b, path, sampling_rate):
+def _compare_services(service_a, service_b, path, sampling_rate, interpolation="spline"):
     stats = defaultdict(list)
-    df = interpolate_missing(pd.concat([service_a.df, service_b.df]), sampling_rate)
+    df = interpolate_missing(pd.concat([service_a.df, service_b.df]), sampling_rate, interpolation)
 
-    for c1, c2 in combine(service_a.df.columns, service_b.df.columns):
+    columns_a = list(service_a.df.columns)
+    columns_b = list(service_b.df.columns)
+    try:
+        # p_a_b[lag, i, j]: does metric j of b granger-cause metric i of a
+        p_a_b = ssr_ftest(df[columns_a].values, df[columns_b].values, 5)
+        p_b_a = ssr_ftest(df[columns_b].values, df[columns_a].values, 5)
+    except ValueError as e:
+        print("error while processing %s -> %s, got: %s" % (service_a.name, service_b.name, e))
+        return pd.DataFrame(stats)
+    trends = {}
+    for (i, c1), (j, c2) in combine(list(enumerate(columns_a)), list(enumerate(columns_b))):
         if c1 == c2:
             continue
-        grangercausality(service_a, service_b, df[[c1, c2]], stats, 5)
-        grangercausality(service_b, service_a, df[[c2, c1]], stats, 5)
+        grangercausality(service_a, service_b, df[[c1, c2]], stats, p_a_b[:, i, j], trends)
+        grangercausality(service_b, service_a, df[[c2, c1]], stats, p_b_a[:, j, i], trends)
     return pd.DataFrame(stats)
 
 #def read_slas_metrics(service_sla, path):
@@ -128,9 +334,14 @@ def _compare_services(service_a, service_b, path, sampling_rate):
 #        metric_path = os.path.join(path, file)
 #        import pdb; pdb.set_trace()
 
-def compare_services(srv_a, srv_b, path, sampling_rate, slas=None):
+def causality_filename(name_a, name_b, path, selected=None):
+    # the full comparison is "best", selected runs never replace it
+    kind = "best" if selected is None else "selected-%d" % selected
+    return os.path.join(path, "%s-%s-causality-callgraph-%s.tsv.gz" % (name_a, name_b, kind))
+
+def compare_services(srv_a, srv_b, path, sampling_rate, slas=None, interpolation="spline"):
     print("%s -> %s" % (srv_a["name"], srv_b["name"]))
-    causality_file = os.path.join(path, "%s-%s-causality-callgraph-best.tsv.gz" % (srv_a["name"], srv_b["name"]))
+    causality_file = causality_filename(srv_a["name"], srv_b["name"], path)
     if os.path.exists(causality_file):
         print("skip %s" % causality_file)
         return
@@ -145,9 +356,104 @@ def compare_services(srv_a, srv_b, path, sampling_rate, slas=None):
     #    df2 = _compare_services(srv_a["name"], slas_a, srv_b["name"], df_b, path, sampling_rate)
     #else:
 
-    df = _compare_services(service_a, service_b, path, sampling_rate)
+    write_causality(service_a, service_b, path, sampling_rate, interpolation)
+
+def report_avoided_tests(services, tasks):
+    tested = 0
+    full = 0
+    for name_a, name_b, *_ in tasks:
+        a, b = services[name_a], services[name_b]
+        tested_edge = count_tests(a.df.columns, b.df.columns)
+        full_edge = count_tests(a.all_metrics, b.all_metrics)
+        print("%s -> %s: %d of %d tests" % (name_a, name_b, tested_edge, full_edge))
+        tested += tested_edge
+        full += full_edge
+    print("%d of %d tests, %d avoided" % (tested, full, full - tested))
+
+def write_causality(service_a, service_b, path, sampling_rate, interpolation="spline", selected=None):
+    df = _compare_services(service_a, service_b, path, sampling_rate, interpolation)
+    causality_file = causality_filename(service_a.name, service_b.name, path, selected)
     df.to_csv(causality_file, sep="\t", compression="gzip")
 
+# services of the parent process, attached by the pool initializer
+_shared_services = {}
+
+def _share_services(services):
+    """
+    copy the frames of services to shared memory, returns the blocks and
+    their description for _attach_services
+    """
+    blocks = []
+    descriptions = {}
+    for service in services:
+        values_shm, values = _share(service.df.values)
+        index_shm, index = _share(service.df.index.values)
+        blocks.extend([values_shm, index_shm])
+        descriptions[service.name] = (values, index, service.df.index.name,
+                                      list(service.df.columns), service.cluster_metrics)
+    return blocks, descriptions
+
+def _attach_services(descriptions):
+    for name, (values, index, index_name, columns, selected_metrics) in descriptions.items():
+        blocks = []
+        arrays = []
+        for shm_name, shape, dtype in [values, index]:
+            shm = shared_memory.SharedMemory(name=shm_name)
+            blocks.append(shm)
+            arrays.append(np.ndarray(shape, dtype, buffer=shm.buf))
+        index = pd.DatetimeIndex(arrays[1], name=index_name)
+        df = pd.DataFrame(arrays[0], index=index, columns=columns, copy=False)
+        _shared_services[name] = (blocks, Service(name, selected_metrics, df))
+
+def _compare_shared_services(args):
+    name_a, name_b, *options = args
+    try:
+        service_a = _shared_services[name_a][1]
+        service_b = _shared_services[name_b][1]
+        write_causality(service_a, service_b, *options)
+        return name_a, name_b, None
+    except Exception:
+        return name_a, name_b, traceback.format_exc()
+
+def compare_services_locally(services, tasks, jobs):
+    """
+    run write_causality for each (name_a, name_b, path, sampling_rate,
+    interpolation, selected) in tasks on a pool of jobs processes, which read the
+    loaded services from shared memory. At most 2 * jobs tasks are submitted
+    at a time; a failed comparison is reported and does not stop the others.
+    """
+    pending = iter(tasks)
+    running = set()
+    failed = []
+    done = 0
+    start = time.monotonic()
+    blocks, descriptions = _share_services(services)
+    try:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_attach_services,
+                                 initargs=(descriptions,)) as executor:
+            while True:
+                for task in itertools.islice(pending, 2 * jobs - len(running)):
+                    running.add(executor.submit(_compare_shared_services, task))
+                if len(running) == 0:
+                    break
+                finished, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name_a, name_b, error = future.result()
+                    done += 1
+                    if error is not None:
+                        sys.stderr.write("comparing %s -> %s failed:\n%s" % (name_a, name_b, error))
+                        failed.append("%s -> %s" % (name_a, name_b))
+                    elapsed = time.monotonic() - start
+                    eta = elapsed / done * (len(tasks) - done)
+                    print("[%d/%d] %s -> %s %s after %.0fs, eta %.0fs" %
+                          (done, len(tasks), name_a, name_b, "failed" if error else "done", elapsed, eta))
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+    if len(failed) > 0:
+        raise RuntimeError("granger causality failed for %s" % ", ".join(failed))
+
 def undirected_callgraph(callgraph):
     uniq = {}
     for edge in callgraph:
@@ -180,7 +486,7 @@ def assign_slas(sla_metrics, measurement_data):
 
 
 def find_causality(path, services_data, args):
-    measurement_data = metadata.load(path)
+    measurement_data = loader.metadata(path)
     call_pairs = undirected_callgraph(services_data["edges"])
 
     services = {}
@@ -202,12 +508,29 @@ def find_causality(path, services_data, args):
         ids = []
         for srv_a, srv_b in call_pairs:
             lview.block = True
-            res = lview.apply_async(_compare_services, (services[srv_a], services[srv_b], path, args.sampling_rate, slas))
+            res = lview.apply_async(_compare_services, (services[srv_a], services[srv_b], path, args.sampling_rate, slas, args.interpolation))
             ids.extend(res.msg_ids)
         return ids
     else:
+        tasks = []
         for srv_a, srv_b in call_pairs:
-            compare_services(services[srv_a], services[srv_b], path, args.sampling_rate, slas)
+            causality_file = causality_filename(srv_a, srv_b, path, args.selected)
+            if os.path.exists(causality_file):
+                print("skip %s" % causality_file)
+                continue
+            tasks.append((srv_a, srv_b, path, args.sampling_rate, args.interpolation, args.selected))
+        # every service is loaded once, also if it is part of many edges
+        names = sorted(set(name for task in tasks for name in task[:2]))
+        loaded = {name: load_service(services[name], path, args.selected) for name in names}
+        record_selected_metrics(path, loaded.values())
+        if args.selected is not None:
+            report_avoided_tests(loaded, tasks)
+        if args.jobs > 1:
+            compare_services_locally(loaded.values(), tasks, args.jobs)
+            return
+        for name_a, name_b, *options in tasks:
+            print("%s -> %s" % (name_a, name_b))
+            write_causality(loaded[name_a], loaded[name_b], *options)
 
 
 def parse_args():
@@ -216,7 +539,10 @@ def parse_args():
     parser.add_argument('measurement_directories', nargs="+", help="measurement directories")
     parser.add_argument('--compare-slas', action='store_true', help="compare metrics with slas")
     parser.add_argument('--sampling-rate', default=(1/2), help="how often data is updated per second")
+    parser.add_argument('--interpolation', choices=INTERPOLATION_METHODS, default="spline", help="how gaps are filled after aligning two services")
     parser.add_argument('--parallel', action='store_true', help="submit job to ipython parallel cluster")
+    parser.add_argument('--selected', type=int, metavar="N", help="only test the N metrics closest to the centroid of each cluster (1: the metric selected by clustering), writes *-causality-callgraph-selected-N.tsv.gz")
+    parser.add_argument('--jobs', type=int, default=1, help="compare N call graph edges at once on local processes (without --parallel)")
     return parser.parse_args()
 
 
@@ -224,7 +550,7 @@ def main():
     args = parse_args()
     ids = []
     for path in args.measurement_directories:
-        if not os.path.exists(os.path.join(path, "metadata.json")):
+        if not os.path.exists(os.path.join(path, "metadata.json")) and not metadatadb.exists(path):
             sys.stderr.write("skip '%s': cannot find metadata.json\n" % path)
             continue
         services_data = json.load(open(args.services_metadata))
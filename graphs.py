@@ -6,6 +6,7 @@ from plot import plt, sns
 from cycler import cycler
 import pandas as pd
 from kshape import _sbd, lag
+import loader
 
 COLORS = [
   "#000000", "#FFFF00", "#1CE6FF", "#FF34FF", "#FF4A46", "#008941", "#006FA6", "#A30059",
@@ -24,7 +25,7 @@ COLORS = [
 ]
 
 def docker_usage(path):
-    data = metadata.load(path)
+    data = loader.metadata(path)
     for service in data["services"]:
         name = "%s/%s-usage.png" % (path, service["name"])
         if os.path.exists(name):
@@ -108,7 +109,7 @@ def write(df, name):
         print("graph %s failed %s" % (name, e))
 
 def draw_graph(name):
-    df = pd.read_csv(name, sep="\t", index_col='time', parse_dates=True)
+    df = loader.read(name)
     write(df, os.path.splitext(name)[0] + ".png")
 
 if __name__ == '__main__':
@@ -1,10 +1,16 @@
 import math
+import time
+from multiprocessing import Pool, shared_memory
 import numpy as np
 
-from numpy.random import randint, seed
+from numpy.random import randint, seed, choice
 from numpy.linalg import norm, eigh
 from numpy.linalg import norm
-from numpy.fft import fft, ifft
+from numpy.fft import fft, ifft, rfft, irfft
+from scipy.sparse.linalg import eigsh, LinearOperator
+
+# series longer than this use the iterative centroid extraction with method="auto"
+DENSE_EXTRACTION_LIMIT = 100
 
 
 def zscore(a, axis=0, ddof=0):
@@ -42,6 +48,9 @@ def roll_zeropad(a, shift, axis=None):
     else:
         return res
 
+def _fft_size(x_len):
+    return 1<<(2*x_len-1).bit_length()
+
 def _ncc_c(x, y):
     """
     >>> _ncc_c([1,2,3,4], [1,2,3,4])
@@ -53,14 +62,128 @@ def _ncc_c(x, y):
     array([-0.15430335, -0.46291005, -0.9258201 , -0.77151675, -0.46291005])
     """
     den = np.array(norm(x) * norm(y))
-    den[den == 0] = np.Inf
+    den[den == 0] = np.inf
 
     x_len = len(x)
-    fft_size = 1<<(2*x_len-1).bit_length()
+    fft_size = _fft_size(x_len)
     cc = ifft(fft(x, fft_size) * np.conj(fft(y, fft_size)))
     cc = np.concatenate((cc[-(x_len-1):], cc[:x_len]))
     return np.real(cc) / den
 
+def _series_fft(x):
+    """
+    fft of every row of x, zero padded for the linear cross-correlation.
+    Computed once per run and reused for every centroid.
+    """
+    x = np.asanyarray(x)
+    return rfft(x, _fft_size(x.shape[-1]))
+
+def _float_dtype(x):
+    if np.issubdtype(x.dtype, np.floating):
+        return x.dtype
+    return np.dtype(np.float64)
+
+def _buffer(work, name, shape, dtype):
+    """
+    view of the given shape into the reusable buffer name of the dict work,
+    which is only reallocated if it is too small
+    """
+    size = int(np.prod(shape))
+    buf = work.get(name)
+    if buf is None or buf.size < size or buf.dtype != dtype:
+        buf = work[name] = np.empty(size, dtype)
+    return buf[:size].reshape(shape)
+
+def _ncc_c_max(x, x_fft, centroids, block_size=1<<22, work=None):
+    """
+    maximum of the normalized cross-correlation of every row of x with every
+    centroid as m x k matrix; same values as max(_ncc_c(x[i], centroids[j])).
+    Pairs are multiplied and transformed back in blocks of rows to bound the
+    memory to about block_size values. The blocks are written into the
+    buffers of work, a dict that can be reused between calls. Computes in
+    the precision of x_fft (complex64 for float32 series).
+
+    >>> x = np.array([[1,2,3,4], [0,1,2,3], [-1,1,-1,1], [0,0,0,0]])
+    >>> c = np.array([[1,1,2,2], [1,-1,1,-1]])
+    >>> ncc = _ncc_c_max(x, _series_fft(x), c)
+    >>> np.allclose(ncc, [[max(_ncc_c(a, b)) for b in c] for a in x])
+    True
+    """
+    if work is None:
+        work = {}
+    m, x_len = x.shape
+    k = len(centroids)
+    fft_size = _fft_size(x_len)
+    real_dtype = x_fft.real.dtype
+    c_fft = np.conj(rfft(np.asarray(centroids, dtype=real_dtype), fft_size))
+
+    den = np.outer(norm(x, axis=1), norm(centroids, axis=1))
+    den[den == 0] = np.inf
+
+    ncc = np.empty(den.shape, dtype=real_dtype)
+    rows = max(1, block_size // (fft_size * k))
+    for start in range(0, m, rows):
+        n = min(rows, m - start)
+        block = _buffer(work, "product", (n, k, x_fft.shape[1]), x_fft.dtype)
+        np.multiply(x_fft[start:start+n, np.newaxis, :], c_fft[np.newaxis, :, :], out=block)
+        cc = _buffer(work, "cc", (n, k, fft_size), real_dtype)
+        irfft(block, fft_size, out=cc)
+        # lags 0..(x_len-1) and -(x_len-1)..-1, the rest is zero padding
+        np.max(cc[:, :, :x_len], axis=2, out=ncc[start:start+n])
+        if x_len > 1:
+            np.maximum(ncc[start:start+n], cc[:, :, fft_size-(x_len-1):].max(axis=2), out=ncc[start:start+n])
+    return ncc / den
+
+def sbd_distances(x, x_fft=None, block_size=1<<22, return_lags=False):
+    """
+    pairwise shape based distances of all rows of x as symmetric m x m matrix
+    with a zero diagonal, as needed for metric='precomputed'. Only the upper
+    triangle is computed, in tiles of about block_size values.
+    With return_lags the antisymmetric matrix of lag(x[i], x[j]) is returned
+    as well.
+
+    >>> x = np.array([[1,2,3,4], [0,1,2,3], [-1,1,-1,1], [0,0,0,0]])
+    >>> d = sbd_distances(x, block_size=8)
+    >>> np.allclose(d, [[_sbd(a, b)[0] if i != j else 0 for j, b in enumerate(x)] for i, a in enumerate(x)])
+    True
+    >>> np.array_equal(d, d.T)
+    True
+    >>> y = np.array([[1,2.5,3,4.2], [0.3,1,2.2,3], [3.1,1,0.2,2]])
+    >>> _, lags = sbd_distances(y, return_lags=True)
+    >>> lags
+    array([[ 0,  0,  0],
+           [ 0,  0, -2],
+           [ 0,  2,  0]])
+    >>> np.array_equal(lags, [[lag(a, b) for b in y] for a in y])
+    True
+    """
+    x = np.asanyarray(x)
+    if x_fft is None:
+        x_fft = _series_fft(x)
+    m, x_len = x.shape
+    fft_size = _fft_size(x_len)
+    valid = np.r_[fft_size-(x_len-1):fft_size, 0:x_len]
+    norms = norm(x, axis=1)
+
+    ncc = np.zeros((m, m))
+    argmax = np.zeros((m, m), dtype=np.int64)
+    rows = max(1, int(math.sqrt(block_size // fft_size)))
+    for i in range(0, m, rows):
+        for j in range(i, m, rows):
+            block = x_fft[i:i+rows, np.newaxis, :] * np.conj(x_fft[np.newaxis, j:j+rows, :])
+            cc = irfft(block, fft_size)[:, :, valid]
+            ncc[i:i+rows, j:j+rows] = cc.max(axis=2)
+            if return_lags:
+                argmax[i:i+rows, j:j+rows] = cc.argmax(axis=2)
+    den = np.outer(norms, norms)
+    den[den == 0] = np.inf
+    distances = np.triu(1 - ncc / den, 1)
+    distances = distances + distances.T
+    if not return_lags:
+        return distances
+    lags = np.triu(x_len - 1 - argmax, 1)
+    return distances, lags - lags.T
+
 def lag(x, y):
     return ((_ncc_c(x, y).argmax() + 1) - max(len(x), len(y))) * -1
 
@@ -81,7 +204,43 @@ def _sbd(x, y):
     return dist, yshift
 
 
-def _extract_shape(idx, x, j, cur_center):
+def _leading_eigenvector(y, method="auto", v0=None):
+    """
+    eigenvector of the largest eigenvalue of p * y^T * y * p, where p is the
+    centering matrix. "dense" builds the matrix and runs a full eigh, "eigsh"
+    applies the centering implicitly in a LinearOperator and only computes
+    the leading eigenvector with Lanczos iterations.
+    """
+    columns = y.shape[1]
+    if method == "auto":
+        method = "eigsh" if columns > DENSE_EXTRACTION_LIMIT else "dense"
+    # eigsh needs at least two columns and does not converge on a zero matrix
+    if method == "eigsh" and columns > 1 and y.any():
+        def matvec(v):
+            v = v.ravel()
+            t = y.T.dot(y.dot(v - v.mean()))
+            return t - t.mean()
+        op = LinearOperator((columns, columns), matvec=matvec, dtype=y.dtype)
+        if v0 is None or not v0.any():
+            # fixed start vector, arpack would pick an unseeded random one
+            v0 = np.random.RandomState(0).uniform(-1, 1, columns).astype(y.dtype)
+        _, vec = eigsh(op, k=1, which="LA", v0=v0)
+        return vec[:, 0]
+    elif method not in ["dense", "eigsh"]:
+        raise ValueError("unknown extraction method: %s" % method)
+
+    s = np.dot(y.transpose(), y)
+
+    p = np.empty((columns, columns), dtype=y.dtype)
+    p.fill(1.0/columns)
+    p = np.eye(columns, dtype=y.dtype) - p
+
+    # these are the 2 most expensive operations
+    m = np.dot(np.dot(p, s), p)
+    _, vec = eigh(m)
+    return vec[:,-1]
+
+def _extract_shape(idx, x, j, cur_center, method="auto", x_fft=None):
     """
     >>> _extract_shape(np.array([0,1,2]), np.array([[1,2,3], [4,5,6]]), 1, np.array([0,3,4]))
     array([-1.,  0.,  1.])
@@ -91,31 +250,53 @@ def _extract_shape(idx, x, j, cur_center):
     array([-1.2089303 , -0.19618238,  0.19618238,  1.2089303 ])
     >>> _extract_shape(np.array([0,0,1,0]), np.array([[1,2,3,4],[0,1,2,3],[-1,1,-1,1],[1,2,2,3]]), 0, np.array([-1.2089303,-0.19618238,0.19618238,1.2089303]))
     array([-1.19623139, -0.26273649,  0.26273649,  1.19623139])
+    >>> x = np.array([[1,2,3,4,3], [0,1,2,3,1], [-1,1,-1,1,0], [1,2,2,3,2]])
+    >>> dense = _extract_shape(np.array([1,0,0,0]), x, 0, np.array([0,0,0,0,0]), method="dense")
+    >>> np.allclose(dense, _extract_shape(np.array([1,0,0,0]), x, 0, np.array([0,0,0,0,0]), method="eigsh"))
+    True
     """
-    _a = []
-    for i in range(len(idx)):
-        if idx[i] == j:
-            if cur_center.sum() == 0:
-                opt_x = x[i]
-            else:
-                _, opt_x = _sbd(cur_center, x[i])
-            _a.append(opt_x)
-    a = np.array(_a)
+    members = np.flatnonzero(np.asarray(idx) == j)
+    return _extract_members_shape(members, x, cur_center, method, x_fft)
 
-    if len(a) == 0:
-        return np.zeros((1, x.shape[1]))
-    columns = a.shape[1]
-    y = zscore(a,axis=1,ddof=1)
-    s = np.dot(y.transpose(), y)
+def _align(x, x_fft, center):
+    """
+    shift every row of x to its best alignment with center, the same as
+    _sbd(center, x[i])[1] for each row, with one batched cross-correlation
+    and a single gather
 
-    p = np.empty((columns, columns))
-    p.fill(1.0/columns)
-    p = np.eye(columns) - p
+    >>> x = np.array([[1,2,3,4], [0,1,2,3], [-1,1,-1,1], [0,0,0,0]])
+    >>> center = np.array([0,1,3,4])
+    >>> np.array_equal(_align(x, _series_fft(x), center), [_sbd(center, row)[1] for row in x])
+    True
+    """
+    x_len = x.shape[1]
+    fft_size = _fft_size(x_len)
+    valid = np.r_[fft_size-(x_len-1):fft_size, 0:x_len]
+    # argmax of the unnormalized cross-correlation is the one of _ncc_c
+    cc = irfft(rfft(center, fft_size) * np.conj(x_fft), fft_size)[:, valid]
+    shifts = cc.argmax(axis=1) + 1 - x_len
+    columns = np.arange(x_len)[np.newaxis, :] - shifts[:, np.newaxis]
+    inside = (columns >= 0) & (columns < x_len)
+    rows = np.arange(x.shape[0])[:, np.newaxis]
+    return np.where(inside, x[rows, np.clip(columns, 0, x_len - 1)], 0)
 
-    # these are the 2 most expensive operations
-    m = np.dot(np.dot(p, s), p)
-    _, vec = eigh(m)
-    centroid = vec[:,-1]
+def _extract_members_shape(members, x, cur_center, method="auto", x_fft=None):
+    """
+    shape extraction for the series selected by members, a boolean mask or
+    an index array over the rows of x
+    """
+    a = x[members]
+    if len(a) == 0:
+        return np.zeros((1, x.shape[1]), dtype=_float_dtype(x))
+    if cur_center.sum() != 0:
+        if x_fft is None:
+            a_fft = _series_fft(a)
+        else:
+            a_fft = x_fft[members]
+        a = _align(a, a_fft, cur_center)
+
+    y = zscore(a,axis=1,ddof=1)
+    centroid = _leading_eigenvector(y, method, v0=cur_center.astype(y.dtype))
     finddistance1 = math.sqrt(((a[0] - centroid) ** 2).sum())
     finddistance2 = math.sqrt(((a[0] + centroid) ** 2).sum())
 
@@ -125,38 +306,197 @@ def _extract_shape(idx, x, j, cur_center):
     return zscore(centroid, ddof=1)
 
 
-def _kshape(x, k, initial_clustering=None):
+def _kshape_plusplus(x, x_fft, k):
+    """
+    k-means++ like seeding with the shape based distance: the first centroid
+    is a random series, each further one is drawn with a probability
+    proportional to the squared distance to its closest centroid so far.
+    Returns the assignment to the closest seed and the seeds as centroids.
+
+    >>> seed(0)
+    >>> x = np.array([[1,2,3,4], [0,1,2,3], [-1,1,-1,1], [1,2,2,3]])
+    >>> _kshape_plusplus(x, _series_fft(x), 2)
+    (array([0, 0, 1, 0]), array([[ 1.,  2.,  3.,  4.],
+           [-1.,  1., -1.,  1.]]))
+    """
+    m = x.shape[0]
+    centers = [randint(0, m)]
+    closest = 1 - _ncc_c_max(x, x_fft, x[centers])[:, 0]
+    for _ in range(1, k):
+        weights = closest ** 2
+        if weights.sum() == 0:
+            # all remaining series have the shape of a centroid already
+            center = randint(0, m)
+        else:
+            center = choice(m, p=weights / weights.sum())
+        centers.append(center)
+        closest = np.minimum(closest, 1 - _ncc_c_max(x, x_fft, x[[center]])[:, 0])
+    centroids = x[centers].astype(_float_dtype(x))
+    idx = (1 - _ncc_c_max(x, x_fft, centroids)).argmin(1)
+    return idx, centroids
+
+def _kshape(x, k, initial_clustering=None, x_fft=None, init="random", trace=None, extract="auto",
+            max_iter=100, tol=0.0, inertia_tol=None):
     """
+    Iterates until at most a fraction tol of the labels changes, the relative
+    change of the inertia drops to inertia_tol (if given), an assignment
+    repeats an earlier one (a cycle) or max_iter is reached. If trace is a
+    list, one dict per iteration is appended with the time spent in shape
+    extraction and assignment, the inertia, the fraction of flipped labels
+    and whether a cycle was detected.
+
     >>> from numpy.random import seed; seed(0)
     >>> _kshape(np.array([[1,2,3,4], [0,1,2,3], [-1,1,-1,1], [1,2,2,3]]), 2)
     (array([0, 0, 1, 0]), array([[-1.2244258 , -0.35015476,  0.52411628,  1.05046429],
            [-0.8660254 ,  0.8660254 , -0.8660254 ,  0.8660254 ]]))
+    >>> seed(0); trace = []
+    >>> _kshape(np.array([[1,2,3,4], [0,1,2,3], [-1,1,-1,1], [1,2,2,3]]), 2, init="kshape++", trace=trace)[0]
+    array([0, 0, 1, 0])
+    >>> len(trace), sorted(trace[0])
+    (1, ['assign_time', 'cycle', 'extract_shape', 'extract_time', 'flips', 'inertia', 'iteration'])
     """
     m = x.shape[0]
+    centroids = np.zeros((k,x.shape[1]), dtype=_float_dtype(x))
+    work = {}
+    if x_fft is None:
+        x_fft = _series_fft(x)
     if initial_clustering is not None:
         assert len(initial_clustering) == m, "Initial assigment does not match column length"
         idx = initial_clustering
-    else:
+    elif init == "kshape++":
+        idx, centroids = _kshape_plusplus(x, x_fft, k)
+    elif init == "random":
         idx = randint(0, k, size=m)
-    centroids = np.zeros((k,x.shape[1]))
-    distances = np.empty((m, k))
+    else:
+        raise ValueError("unknown init method: %s" % init)
 
-    for _ in range(100):
+    seen = set([np.asarray(idx).tobytes()])
+    inertia = np.inf
+    for iteration in range(max_iter):
         old_idx = idx
+        start = time.perf_counter()
         for j in range(k):
-            centroids[j] = _extract_shape(idx, x, j, centroids[j])
+            centroids[j] = _extract_shape(idx, x, j, centroids[j], extract, x_fft)
+        extracted = time.perf_counter()
 
-        for i in range(m):
-             for j in range(k):
-                 distances[i,j] = 1 - max(_ncc_c(x[i], centroids[j]))
+        distances = 1 - _ncc_c_max(x, x_fft, centroids, work=work)
         idx = distances.argmin(1)
-        if np.array_equal(old_idx, idx):
+        assigned = time.perf_counter()
+
+        old_inertia, inertia = inertia, distances[np.arange(m), idx].sum()
+        flips = np.mean(old_idx != idx)
+        labels = idx.tobytes()
+        cycle = flips > 0 and labels in seen
+        seen.add(labels)
+        if trace is not None:
+            trace.append(dict(iteration=iteration + 1,
+                              extract_shape=k,
+                              extract_time=extracted - start,
+                              assign_time=assigned - extracted,
+                              inertia=inertia,
+                              flips=flips,
+                              cycle=cycle))
+        if flips <= tol or cycle:
+            break
+        if inertia_tol is not None and abs(old_inertia - inertia) <= inertia_tol * abs(inertia):
             break
 
     return idx, centroids
 
-def kshape(x, k, initial_clustering=None):
-    idx, centroids = _kshape(np.array(x), k, initial_clustering)
+def _inertia(x, x_fft, idx, centroids):
+    """
+    sum of the shape based distances of all series to their centroid
+    """
+    ncc = _ncc_c_max(x, x_fft, centroids)
+    return (1 - ncc[np.arange(len(idx)), idx]).sum()
+
+def _kshape_restart(x, x_fft, k, restart_seed, options):
+    seed(restart_seed)
+    trace = []
+    idx, centroids = _kshape(x, k, x_fft=x_fft, trace=trace, **options)
+    return _inertia(x, x_fft, idx, centroids), idx, centroids, trace
+
+# arrays of the parent process, attached by the pool initializer
+_shared_arrays = {}
+
+def _share(a):
+    shm = shared_memory.SharedMemory(create=True, size=max(1, a.nbytes))
+    np.ndarray(a.shape, a.dtype, buffer=shm.buf)[...] = a
+    return shm, (shm.name, a.shape, a.dtype.str)
+
+def _attach_shared(arrays):
+    for key, (name, shape, dtype) in arrays.items():
+        shm = shared_memory.SharedMemory(name=name)
+        _shared_arrays[key] = (shm, np.ndarray(shape, dtype, buffer=shm.buf))
+
+def _kshape_shared_restart(k, restart_seed, options):
+    x = _shared_arrays["x"][1]
+    x_fft = _shared_arrays["x_fft"][1]
+    return _kshape_restart(x, x_fft, k, restart_seed, options)
+
+def _kshape_restarts(x, k, n_init, n_jobs, options):
+    """
+    best of n_init seeded runs of _kshape by inertia. With n_jobs > 1 the runs
+    are distributed on a local process pool, which reads the series and
+    their ffts from shared memory instead of receiving a pickled copy.
+    """
+    seeds = randint(0, 2**31 - 1, size=n_init)
+    x_fft = _series_fft(x)
+    if n_jobs == 1:
+        results = [_kshape_restart(x, x_fft, k, s, options) for s in seeds]
+    else:
+        x_shm, x_desc = _share(x)
+        fft_shm, fft_desc = _share(x_fft)
+        try:
+            descriptions = dict(x=x_desc, x_fft=fft_desc)
+            with Pool(n_jobs, initializer=_attach_shared, initargs=(descriptions,)) as pool:
+                results = pool.starmap(_kshape_shared_restart, [(k, s, options) for s in seeds])
+        finally:
+            for shm in [x_shm, fft_shm]:
+                shm.close()
+                shm.unlink()
+    best = min(results, key=lambda res: res[0])
+    return best[1:]
+
+def kshape(x, k, initial_clustering=None, n_init=1, n_jobs=1, init="random", trace=None, extract="auto", dtype=None,
+           max_iter=100, tol=0.0, inertia_tol=None):
+    """
+    cluster the rows of x into k clusters, returns a list of
+    (centroid, indices of assigned series) tuples. With n_init > 1 k-Shape
+    is restarted from n_init random assignments, using n_jobs processes, and
+    the result with the lowest inertia is kept.
+    init is either "random" labels or "kshape++" seeding. If trace is a list,
+    one entry per iteration (of the best restart) is appended to it.
+    extract selects the centroid extraction, see _leading_eigenvector.
+    max_iter, tol and inertia_tol are the stopping criteria of _kshape.
+    dtype=np.float32 runs all buffers and ffts in single precision, which
+    roughly halves the memory.
+
+    >>> x = np.array([[1,2,3,4], [0,1,2,3], [-1,1,-1,1], [1,2,2,3], [1,-1,1,-1]])
+    >>> seed(0); single = kshape(x, 2, n_init=4)
+    >>> seed(0); parallel = kshape(x, 2, n_init=4, n_jobs=2)
+    >>> [series for _, series in single] == [series for _, series in parallel]
+    True
+    >>> t = np.arange(200)
+    >>> x = np.array([np.sin(t / (5. + i % 3)) + np.sin(t / 20. + i) for i in range(12)])
+    >>> seed(1); double = kshape(x, 3)
+    >>> seed(1); single = kshape(x, 3, dtype=np.float32)
+    >>> [series for _, series in single] == [series for _, series in double]
+    True
+    >>> single[0][0].dtype
+    dtype('float32')
+    """
+    x = np.array(x, dtype=dtype)
+    options = dict(init=init, extract=extract, max_iter=max_iter, tol=tol, inertia_tol=inertia_tol)
+    if n_init > 1 and initial_clustering is None:
+        idx, centroids, best_trace = _kshape_restarts(x, k, n_init, n_jobs, options)
+        if trace is not None:
+            trace.extend(best_trace)
+    else:
+        idx, centroids = _kshape(x, k, initial_clustering, trace=trace, **options)
+    return _clusters(idx, centroids)
+
+def _clusters(idx, centroids):
     clusters = []
     for i, centroid in enumerate(centroids):
         series = []
@@ -166,6 +506,156 @@ def kshape(x, k, initial_clustering=None):
         clusters.append((centroid, series))
     return clusters
 
+def _split_worst(x, x_fft, idx, centroids, extract="auto"):
+    """
+    assignment to len(centroids) + 1 clusters: the cluster with the largest
+    summed distance to its centroid is split in two by running k-Shape on
+    its members only; the second half becomes the new cluster
+
+    >>> seed(0)
+    >>> x = np.array([[1,2,3,4], [0,1,2,3], [-1,1,-1,1], [1,-1,1,-1.5]])
+    >>> idx, centroids = _kshape(x, 1)
+    >>> new_idx = _split_worst(x, _series_fft(x), idx, centroids)
+    >>> [bool(new_idx[0] == new_idx[1]), bool(new_idx[2] == new_idx[3]), bool(new_idx[0] != new_idx[2])]
+    [True, True, True]
+    """
+    k = len(centroids)
+    ncc = _ncc_c_max(x, x_fft, centroids)
+    distances = 1 - ncc[np.arange(len(idx)), idx]
+    cost = np.bincount(idx, weights=distances, minlength=k)
+    # only clusters with at least two members can be split
+    cost[np.bincount(idx, minlength=k) < 2] = -np.inf
+    worst = cost.argmax()
+    members = np.flatnonzero(idx == worst)
+    new_idx = idx.copy()
+    if len(members) < 2:
+        return new_idx
+    halves, _ = _kshape(x[members], 2, x_fft=x_fft[members], init="kshape++", extract=extract)
+    new_idx[members[halves == 1]] = k
+    return new_idx
+
+def kshape_sweep(x, cluster_sizes, init="random", extract="auto", dtype=None, tol=0.0, trace=None):
+    """
+    k-Shape for all cluster sizes of a service in one go. The series and their
+    ffts are prepared once; the smallest size starts from init, every further
+    size k+1 starts from the k solution with its worst cluster split in two.
+    Yields (cluster_size, clusters) in ascending order, clusters as kshape
+    returns them. tol is the stopping criterion of _kshape; if trace is a
+    list, the iterations of every size are appended to it with their
+    cluster_size.
+
+    >>> seed(0)
+    >>> x = np.array([[1,2,3,4], [0,1,2,3], [-1,1,-1,1], [1,-1,1,-1.5], [3,1,0,2]])
+    >>> trace = []
+    >>> [(k, len(clusters)) for k, clusters in kshape_sweep(x, [1, 2, 4], trace=trace)]
+    [(1, 1), (2, 2), (4, 4)]
+    >>> sorted(set(entry["cluster_size"] for entry in trace))
+    [1, 2, 3, 4]
+    """
+    x = np.array(x, dtype=dtype)
+    x_fft = _series_fft(x)
+    def run(k, initial_clustering=None):
+        steps = None if trace is None else []
+        res = _kshape(x, k, initial_clustering, x_fft=x_fft, init=init, trace=steps, extract=extract, tol=tol)
+        if trace is not None:
+            trace.extend(dict(entry, cluster_size=k) for entry in steps)
+        return res
+    cluster_sizes = sorted(cluster_sizes)
+    idx, centroids = run(cluster_sizes[0])
+    yield cluster_sizes[0], _clusters(idx, centroids)
+    k = cluster_sizes[0]
+    for cluster_size in cluster_sizes[1:]:
+        # intermediate sizes are computed as well to keep the chain of splits
+        while k < cluster_size:
+            initial_clustering = _split_worst(x, x_fft, idx, centroids, extract)
+            k += 1
+            idx, centroids = run(k, initial_clustering)
+        yield cluster_size, _clusters(idx, centroids)
+
+def _window_stats(chunks):
+    """
+    mean and standard deviation of every series over all windows
+    """
+    count, total, squares = 0, 0, 0
+    for chunk in chunks():
+        chunk = np.asarray(chunk, dtype=np.float64)
+        count += chunk.shape[1]
+        total = total + chunk.sum(axis=1)
+        squares = squares + (chunk ** 2).sum(axis=1)
+    mean = total / count
+    return mean, np.sqrt(np.maximum(squares / count - mean ** 2, 0))
+
+def kshape_windowed(chunks, k, initial_clustering=None, max_iter=100, tol=0.0, extract="auto", trace=None, dtype=np.float64):
+    """
+    k-Shape for measurements too long to keep all series in memory.
+    chunks is a callable returning an iterator over consecutive time windows
+    of all series, each a m x w array. Series are z-scored with their mean and
+    deviation over the whole measurement. Every iteration is one pass over the
+    windows: the centroid of each window is extracted from the members of
+    the previous assignment, and the NCC of each series with it is
+    accumulated, weighted by the window length. Stops when at most a
+    fraction tol of the labels changes or an assignment repeats. Returns
+    clusters like kshape; trace is filled like the one of _kshape.
+
+    >>> seed(0)
+    >>> x = np.array([[1,2,3,4,5,6,7,8], [0,1,2,3,4,5,7,7], [1,5,1,5,1,5,1,5.5], [0,4,0,4,0,4.5,0,4]])
+    >>> clusters = kshape_windowed(lambda: iter([x[:, :4], x[:, 4:]]), 2)
+    >>> sorted(series for _, series in clusters)
+    [[0, 1], [2, 3]]
+    """
+    mean, std = _window_stats(chunks)
+    std[std == 0] = np.inf
+    m = len(mean)
+    if initial_clustering is not None:
+        assert len(initial_clustering) == m, "Initial assigment does not match column length"
+        idx = np.asarray(initial_clustering)
+    else:
+        idx = randint(0, k, size=m)
+    # centroid of every window, the full centroids are only built at the end
+    windows = []
+
+    seen = set([idx.tobytes()])
+    for iteration in range(max_iter):
+        ncc = np.zeros((m, k))
+        length = 0
+        extract_time, assign_time = 0, 0
+        for i, chunk in enumerate(chunks()):
+            z = ((np.asarray(chunk, dtype=np.float64) - mean[:, np.newaxis]) / std[:, np.newaxis]).astype(dtype)
+            z_fft = _series_fft(z)
+            if len(windows) <= i:
+                windows.append(np.zeros((k, z.shape[1]), dtype=dtype))
+            start = time.perf_counter()
+            for j in range(k):
+                windows[i][j] = _extract_members_shape(idx == j, z, windows[i][j], extract, z_fft)
+            extracted = time.perf_counter()
+            ncc += _ncc_c_max(z, z_fft, windows[i]) * z.shape[1]
+            length += z.shape[1]
+            assign_time += time.perf_counter() - extracted
+            extract_time += extracted - start
+        old_idx = idx
+        distances = 1 - ncc / length
+        idx = distances.argmin(1)
+        flips = (old_idx != idx).mean()
+        labels = idx.tobytes()
+        cycle = flips > 0 and labels in seen
+        seen.add(labels)
+        if trace is not None:
+            trace.append(dict(iteration=iteration + 1,
+                              extract_shape=k * len(windows),
+                              extract_time=extract_time,
+                              assign_time=assign_time,
+                              inertia=distances[np.arange(m), idx].sum(),
+                              flips=flips,
+                              cycle=cycle))
+        if flips <= tol or cycle:
+            break
+
+    centroids = zscore(np.concatenate(windows, axis=1), axis=1, ddof=1)
+    clusters = []
+    for j, centroid in enumerate(centroids):
+        clusters.append((centroid, np.flatnonzero(idx == j).tolist()))
+    return clusters
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
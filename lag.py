@@ -6,17 +6,14 @@ import pandas as pd
 from plot import plt, sns
 
 from kshape import kshape, zscore
-
-def load_metadata(path):
-    with open(os.path.join(path, "metadata.json")) as f:
-        return json.load(f)
+import loader
 
 def centroids(path):
-    metadata = load_metadata(path)
+    metadata = loader.metadata(path)
     d = {}
     for srv in metadata["services"]:
         name = "%s/%s-cluster-1_1.tsv" % (path, srv["name"])
-        df = pd.read_csv(name, sep="\t", index_col='time', parse_dates=True)
+        df = loader.read(name)
         d[srv["name"]] = df.centroid
     df2 = pd.DataFrame(d)
     df2 = df2.fillna(method="bfill", limit=1e9)
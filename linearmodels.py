@@ -12,6 +12,7 @@ import multiprocessing as mp
 from scipy.stats import linregress
 
 import metadata
+import loader
 from plot import plt, sns
 from preprocess import diff
 
@@ -26,7 +27,7 @@ def parse_args():
 def load_metadata(measurements):
     stats = defaultdict(list)
     for measurement in measurements:
-        data = metadata.load(measurement)
+        data = loader.metadata(measurement)
         name = data["name"]
         m = re.match(r".*scale(?P<scale>\d+)", name)
         if m is None:
@@ -41,7 +42,7 @@ def load_metadata(measurements):
     return pd.DataFrame(stats)
 
 def load_measurement(filename):
-    return pd.read_csv(filename, sep="\t", index_col='time', parse_dates=True)
+    return loader.preprocessed(filename)
 
 def _linearregression(m, service_a, service_b):
     stats = defaultdict(list)
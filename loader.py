@@ -0,0 +1,75 @@
+"""
+shared reader for measurement files
+
+Every script reads metadata.json, the preprocessed services and the cluster
+files through this module. Results are kept in a small in-process LRU cache
+keyed on the file path and its modification time, so a file that is used
+by many call-graph edges or service pairs is parsed once per run and a
+rewritten file is read again.
+
+The returned objects are shared between callers: do not modify them in
+place, copy them first.
+"""
+import os
+import copy
+from collections import OrderedDict
+
+import pandas as pd
+
+import metadata as _metadata
+import store
+
+MAX_ENTRIES = 32
+
+_cache = OrderedDict()
+
+def _stamp(filenames):
+    stamp = []
+    for filename in filenames:
+        try:
+            st = os.stat(filename)
+            stamp.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            stamp.append(None)
+    return tuple(stamp)
+
+def _cached(kind, filenames, read):
+    key = (kind, os.path.abspath(filenames[0]))
+    stamp = _stamp(filenames)
+    entry = _cache.get(key)
+    if entry is not None and entry[0] == stamp:
+        _cache.move_to_end(key)
+        return entry[1]
+    value = read()
+    _cache[key] = (stamp, value)
+    _cache.move_to_end(key)
+    while len(_cache) > MAX_ENTRIES:
+        _cache.popitem(last=False)
+    return value
+
+def clear():
+    _cache.clear()
+
+def metadata(path):
+    """
+    metadata.json of a measurement, a copy that may be changed by the caller
+    """
+    filenames = [os.path.join(path, f) for f in ["metadata.json", "metadata.sqlite"]]
+    data = _cached("metadata", filenames, lambda: _metadata.load(path))
+    return copy.deepcopy(data)
+
+def read(filename):
+    """
+    time indexed tsv file that is read more than once per run, e.g. a cluster
+    file. Raw measurements are read once and would only keep the largest
+    frames alive, read them with pd.read_csv.
+    """
+    return _cached("tsv", [filename],
+                   lambda: pd.read_csv(filename, sep="\t", index_col='time', parse_dates=True))
+
+def preprocessed(filename):
+    """
+    preprocessed metrics of a service, from the binary store if available
+    """
+    base = store._base(filename)
+    return _cached("preprocessed", [filename, base + ".json"], lambda: store.read(filename))
@@ -1,15 +1,48 @@
+"""
+load, save and update the metadata.json of a measurement
+
+update locks the metadata and rewrites it when the block ends. Worker
+processes that update often can switch to write-behind instead, either with
+write_behind(interval) or by setting METADATA_WRITE_BEHIND=<seconds>: update
+then only records the changes of the block as patch operations in a journal of
+the process, and flush merges the journal into the metadata in one locked
+pass. The journal is flushed by the first update after interval seconds, by
+flush() and at process exit; changes of a killed process are lost. This
+includes the workers of a multiprocessing.Pool, which are terminated when the
+pool is closed: a pool task that updates the metadata has to call flush()
+before it returns (see preprocess._process_service).
+"""
 from contextlib import contextmanager
 import tempfile
 import os
+import time
 import json
 import fcntl
-from collections import OrderedDict
+import atexit
+from collections import OrderedDict, defaultdict
+from multiprocessing import util
+
+import metadatadb
+
+# seconds between journal flushes, None disables write-behind
+WRITE_BEHIND_INTERVAL = None
+if os.environ.get("METADATA_WRITE_BEHIND"):
+    WRITE_BEHIND_INTERVAL = float(os.environ["METADATA_WRITE_BEHIND"])
+
+# measurement path -> pending patch operations of this process
+_journal = defaultdict(list)
+_last_flush = {}
+_exit_hooks_pid = None
 
 def load(path):
+    if metadatadb.exists(path):
+        return metadatadb.load(path)
     with open(os.path.join(path, "metadata.json")) as f:
         return json.load(f)
 
 def save(path, metadata):
+    if metadatadb.exists(path):
+        return metadatadb.save(path, metadata)
     p = os.path.join(path, "metadata.json")
     with _atomic_write(p) as f:
         # http://www.psf.upfronthosting.co.za/issue25457
@@ -24,20 +57,176 @@ def update(path):
     """
     allow concurrent update of metadata
     """
+    if WRITE_BEHIND_INTERVAL is None:
+        with _update(path) as data:
+            yield data
+        return
+    old = load(path)
+    for op in _journal[path]:
+        _apply(old, op)
+    data = json.loads(json.dumps(old))
+    yield data
+    # int keys become strings in json, compare what would be written
+    _journal[path].extend(_diff(old, json.loads(json.dumps(data))))
+    _register_exit_hooks()
+    last = _last_flush.setdefault(path, time.monotonic())
+    if time.monotonic() - last >= WRITE_BEHIND_INTERVAL:
+        flush(path)
+
+@contextmanager
+def _update(path):
+    if metadatadb.exists(path):
+        with metadatadb.update(path) as data:
+            yield data
+        return
     p = os.path.join(path, "metadata.json")
-    # we have to open writeable to get a lock
-    with open(p, "a") as f:
-        fcntl.lockf(f, fcntl.LOCK_EX)
+    while True:
+        # we have to open writeable to get a lock
+        f = open(p, "a")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        # save replaces the file, a lock on the old one protects nothing.
+        # flock, not lockf: closing the file in load would drop a lockf lock
+        if os.fstat(f.fileno()).st_ino == os.stat(p).st_ino:
+            break
+        f.close()
+    with f:
         data = load(path)
         yield(data)
         save(path, data)
-        fcntl.lockf(f, fcntl.LOCK_UN)
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+def write_behind(interval=10.0):
+    """
+    journal updates of this process and merge them every interval seconds,
+    None writes every update through again (after flushing the journal)
+    """
+    global WRITE_BEHIND_INTERVAL
+    if interval is None:
+        flush()
+    WRITE_BEHIND_INTERVAL = interval
+
+def flush(path=None):
+    """
+    merge the journal of this process into the metadata, of all measurements
+    if path is None
+    """
+    paths = list(_journal) if path is None else [path]
+    for p in paths:
+        ops = _journal.pop(p, [])
+        if len(ops) > 0:
+            with _update(p) as data:
+                for op in ops:
+                    _apply(data, op)
+        _last_flush[p] = time.monotonic()
+
+def _register_exit_hooks():
+    global _exit_hooks_pid
+    if _exit_hooks_pid == os.getpid():
+        return
+    _exit_hooks_pid = os.getpid()
+    atexit.register(flush)
+    # multiprocessing children leave with os._exit, which skips atexit
+    util.Finalize(None, flush, exitpriority=10)
+
+def _reset_in_child():
+    global _exit_hooks_pid
+    # the pending operations belong to the parent, which flushes them itself;
+    # a forked child replaying them would overwrite newer data
+    _journal.clear()
+    _last_flush.clear()
+    _exit_hooks_pid = None
+
+os.register_at_fork(after_in_child=_reset_in_child)
+
+def _named(value):
+    """
+    lists of named objects (the services) are patched by name, not position
+    """
+    return (isinstance(value, list) and len(value) > 0
+            and all(isinstance(v, dict) and "name" in v for v in value))
+
+def _diff(old, new, path=()):
+    """
+    patch operations that turn old into new, in the spirit of json patch
+    (rfc 6902): dict keys are path steps, {"name": ...} selects a named item
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        items = lambda d: d.items()
+        step = lambda key: key
+    elif _named(old) and _named(new):
+        items = lambda l: ((v["name"], v) for v in l)
+        step = lambda name: {"name": name}
+    else:
+        if old != new:
+            return [dict(op="replace", path=list(path), value=new)]
+        return []
+    old_items = dict(items(old))
+    new_items = dict(items(new))
+    ops = []
+    for key, value in new_items.items():
+        if key in old_items:
+            ops.extend(_diff(old_items[key], value, path + (step(key),)))
+        else:
+            ops.append(dict(op="add", path=list(path + (step(key),)), value=value))
+    for key in old_items.keys() - new_items.keys():
+        ops.append(dict(op="remove", path=list(path + (step(key),))))
+    return ops
+
+def _apply(data, op):
+    """
+    apply one operation of _diff, operations below an object that another
+    process removed in the meantime are dropped. Adding an object that
+    another process added in the meantime merges their keys, so the
+    clusters of two workers that both created the dict are kept.
+    """
+    *parents, last = op["path"]
+    target = data
+    for step in parents:
+        target = _child(target, step)
+        if target is None:
+            return
+    if isinstance(last, dict):
+        if not isinstance(target, list):
+            return
+        for i, v in enumerate(target):
+            if isinstance(v, dict) and v.get("name") == last["name"]:
+                if op["op"] == "remove":
+                    del target[i]
+                elif op["op"] == "add" and isinstance(op["value"], dict):
+                    _merge(v, op["value"])
+                else:
+                    target[i] = op["value"]
+                return
+        if op["op"] != "remove":
+            target.append(op["value"])
+    elif isinstance(target, dict):
+        if op["op"] == "remove":
+            target.pop(last, None)
+        elif op["op"] == "add" and isinstance(op["value"], dict) and isinstance(target.get(last), dict):
+            _merge(target[last], op["value"])
+        else:
+            target[last] = op["value"]
+
+def _merge(target, value):
+    for key, v in value.items():
+        _apply(target, dict(op="add", path=[key], value=v))
+
+def _child(target, step):
+    if isinstance(step, dict):
+        if isinstance(target, list):
+            for v in target:
+                if isinstance(v, dict) and v.get("name") == step["name"]:
+                    return v
+        return None
+    if isinstance(target, dict):
+        return target.get(step)
+    return None
 
 @contextmanager
-def _atomic_write(filename):
+def _atomic_write(filename, mode="w+"):
     path = os.path.dirname(filename)
     try:
-        file = tempfile.NamedTemporaryFile(delete=False, dir=path, mode="w+")
+        file = tempfile.NamedTemporaryFile(delete=False, dir=path, mode=mode)
         yield file
         file.flush()
         os.fsync(file.fileno())
@@ -0,0 +1,182 @@
+"""
+SQLite backend for the measurement metadata
+
+If a measurement directory contains metadata.sqlite, metadata.load, save
+and update use it instead of metadata.json, which is then no longer read
+or updated. An update only writes the rows it changed: one row per top
+level key, per service, per cluster size of a service and per selected
+metrics list (the grangercausality-metrics of a cluster). Create it from
+metadata.json with
+
+    python metadatadb.py import <measurement>...
+
+and write the (otherwise stale) metadata.json again from it with
+
+    python metadatadb.py export <measurement>...
+
+The database uses the rollback journal, not WAL: the WAL index lives in
+shared memory, which processes on different hosts of an NFS share do not
+have in common. The rollback journal relies on POSIX file locks instead, so
+on NFS the server has to support locking.
+"""
+import os
+import sys
+import json
+import sqlite3
+from contextlib import contextmanager
+from collections import OrderedDict
+
+import metadata
+
+FILENAME = "metadata.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS measurement (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS services (name TEXT PRIMARY KEY, position INTEGER NOT NULL, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS clusters (service TEXT NOT NULL, cluster_size TEXT NOT NULL, value TEXT NOT NULL,
+                                     PRIMARY KEY (service, cluster_size));
+CREATE TABLE IF NOT EXISTS selected_metrics (service TEXT NOT NULL, cluster_size TEXT NOT NULL, metrics TEXT NOT NULL,
+                                             PRIMARY KEY (service, cluster_size));
+"""
+
+SELECTED_METRICS = "grangercausality-metrics"
+
+def exists(path):
+    return os.path.exists(os.path.join(path, FILENAME))
+
+def connect(path):
+    db = sqlite3.connect(os.path.join(path, FILENAME), timeout=600, isolation_level=None)
+    # WAL needs shared memory between all clients, see above
+    db.execute("PRAGMA journal_mode=DELETE")
+    db.executescript(SCHEMA)
+    return db
+
+def _rows(data):
+    """
+    split the metadata dict into the rows of each table, keyed by primary key
+    """
+    rows = dict(measurement={}, services={}, clusters={}, selected_metrics={})
+    for key, value in data.items():
+        if key != "services":
+            rows["measurement"][(key,)] = (json.dumps(value),)
+    for position, srv in enumerate(data.get("services", [])):
+        srv = dict(srv)
+        clusters = srv.pop("clusters", None)
+        if clusters is not None:
+            # keep an empty cluster dict apart from a missing one
+            srv["clusters"] = {}
+            for size, cluster in clusters.items():
+                cluster = dict(cluster)
+                if SELECTED_METRICS in cluster:
+                    metrics = cluster.pop(SELECTED_METRICS)
+                    rows["selected_metrics"][(srv["name"], str(size))] = (json.dumps(metrics),)
+                rows["clusters"][(srv["name"], str(size))] = (json.dumps(cluster),)
+        rows["services"][(srv["name"],)] = (position, json.dumps(srv))
+    return rows
+
+def _read_rows(db):
+    rows = {}
+    rows["measurement"] = {(k,): (v,) for k, v in db.execute("SELECT key, value FROM measurement")}
+    rows["services"] = {(n,): (p, v) for n, p, v in db.execute("SELECT name, position, value FROM services")}
+    rows["clusters"] = {(s, c): (v,) for s, c, v in db.execute("SELECT service, cluster_size, value FROM clusters")}
+    rows["selected_metrics"] = {(s, c): (m,) for s, c, m in
+                                db.execute("SELECT service, cluster_size, metrics FROM selected_metrics")}
+    return rows
+
+def _data(rows):
+    data = {}
+    for (key,), (value,) in rows["measurement"].items():
+        data[key] = json.loads(value)
+    services = []
+    by_name = {}
+    for (name,), (position, value) in sorted(rows["services"].items(), key=lambda r: r[1][0]):
+        srv = json.loads(value)
+        services.append(srv)
+        by_name[name] = srv
+    for (service, size), (value,) in rows["clusters"].items():
+        by_name[service].setdefault("clusters", {})[size] = json.loads(value)
+    for (service, size), (metrics,) in rows["selected_metrics"].items():
+        by_name[service]["clusters"][size][SELECTED_METRICS] = json.loads(metrics)
+    if len(services) > 0 or "services" in data:
+        data["services"] = services
+    return data
+
+COLUMNS = {
+    "measurement": ["key", "value"],
+    "services": ["name", "position", "value"],
+    "clusters": ["service", "cluster_size", "value"],
+    "selected_metrics": ["service", "cluster_size", "metrics"],
+}
+
+def _write_changes(db, old, new):
+    for table, columns in COLUMNS.items():
+        placeholders = ", ".join("?" * len(columns))
+        key_columns = columns[:2] if table in ["clusters", "selected_metrics"] else columns[:1]
+        for key, value in new[table].items():
+            if old[table].get(key) != value:
+                db.execute("INSERT OR REPLACE INTO %s (%s) VALUES (%s)" % (table, ", ".join(columns), placeholders),
+                           key + value)
+        for key in old[table].keys() - new[table].keys():
+            where = " AND ".join("%s = ?" % c for c in key_columns)
+            db.execute("DELETE FROM %s WHERE %s" % (table, where), key)
+
+def load(path):
+    db = connect(path)
+    try:
+        return _data(_read_rows(db))
+    finally:
+        db.close()
+
+def save(path, data):
+    db = connect(path)
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        _write_changes(db, _read_rows(db), _rows(data))
+        db.execute("COMMIT")
+    finally:
+        db.close()
+
+@contextmanager
+def update(path):
+    """
+    like metadata.update: the write lock of the database is held while the
+    caller changes the data, afterwards only changed rows are written
+    """
+    db = connect(path)
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        old = _read_rows(db)
+        data = _data(old)
+        yield data
+        _write_changes(db, old, _rows(data))
+        db.execute("COMMIT")
+    finally:
+        if db.in_transaction:
+            db.execute("ROLLBACK")
+        db.close()
+
+def import_json(path):
+    """
+    create metadata.sqlite from metadata.json
+    """
+    with open(os.path.join(path, "metadata.json")) as f:
+        data = json.load(f)
+    save(path, data)
+
+def export_json(path, filename=None):
+    """
+    write the database as metadata.json (or filename), in metadata.save's format
+    """
+    if filename is None:
+        filename = os.path.join(path, "metadata.json")
+    with metadata._atomic_write(filename) as f:
+        data = OrderedDict(sorted(load(path).items(), key=str))
+        json.dump(data, f, indent=4, separators=(',', ': '))
+
+if __name__ == "__main__":
+    commands = {"import": import_json, "export": export_json}
+    if len(sys.argv) < 3 or sys.argv[1] not in commands:
+        sys.stderr.write("USAGE: %s import|export measurement...\n" % sys.argv[0])
+        sys.exit(1)
+    for arg in sys.argv[2:]:
+        commands[sys.argv[1]](arg)
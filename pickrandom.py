@@ -6,6 +6,7 @@ from numpy.random import choice
 import math
 from collections import defaultdict
 import metadata
+import loader
 import os
 import re
 from sklearn import metrics
@@ -29,7 +30,7 @@ plt.tick_params(labelsize=40)
 def load_cluster_assignments(measurements):
     all_measurements = defaultdict(list)
     for m in measurements:
-        data = metadata.load(m)
+        data = loader.metadata(m)
         for srv in data["services"]:
             if srv["name"] == "loadgenerator":
                 continue
@@ -63,7 +64,7 @@ def print_cluster(idx, cluster):
     imgs = ""
     size = cluster.cluster_size
     for i, name in enumerate(cluster.filenames):
-        df = pd.read_csv(name, sep="\t", index_col='time', parse_dates=True)
+        df = loader.read(name)
 
         columns = list(df.columns)
         columns.remove("centroid")
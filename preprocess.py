@@ -1,28 +1,86 @@
 import os
 import sys
+import io
+import gzip
+import itertools
 import argparse
+import traceback
+from multiprocessing import Pool
 
 import pandas as pd
 import numpy as np
 
 import metadata
+import sbdcache
+import store
+from metadata import _atomic_write
 from kshape import zscore
 
 def load_timeseries(filename, service):
+    # raw measurements are read once, not through the loader cache (see loader.read)
     df = pd.read_csv(filename, sep="\t", index_col='time', parse_dates=True)
     if "cpu" in df and not df["cpu"].isnull().all():
         df = df[df["cpu"].isnull() | (df["cpu"] == "cpu-total")]
     return df[service["fields"]]
 
 def is_monotonic(serie):
-    if serie.dtype == np.float64:
-        return pd.algos.is_monotonic_float64(serie.values, False)[0]
-    elif serie.dtype == np.int64:
-        return pd.algos.is_monotonic_int64(serie.values, False)[0]
+    if serie.dtype == np.float64 or serie.dtype == np.int64:
+        return serie.is_monotonic_increasing
     else:
         raise ValueError("unexpected column type: %s" % serie.dtype)
 
-def classify_series(df):
+RESAMPLE_INTERVAL = "500ms"
+# one timestamp format for all preprocessed tsv files: to_csv picks the
+# shortest format per call, so chunks written one by one could mix
+# "00:00:01" and "00:00:01.500", which read_csv does not parse as dates
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f%z"
+
+def write_tsv(df, out, header=True):
+    """
+    write df to the open file out like to_csv, with the fixed DATE_FORMAT
+
+    >>> import io
+    >>> index = pd.date_range("2017-01-01", periods=6, freq=RESAMPLE_INTERVAL, name="time")
+    >>> df = pd.DataFrame(dict(a=np.arange(6.0)), index=index)
+    >>> whole, chunked = io.StringIO(), io.StringIO()
+    >>> write_tsv(df, whole)
+    >>> write_tsv(df.iloc[:0], chunked)
+    >>> for chunk in [df.iloc[:2], df.iloc[2:3], df.iloc[3:]]:
+    ...     write_tsv(chunk, chunked, header=False)
+    >>> def parse(f):
+    ...     return pd.read_csv(io.StringIO(f.getvalue()), sep="\\t", index_col='time', parse_dates=True)
+    >>> parse(chunked).index.equals(parse(whole).index), parse(chunked).index.equals(index)
+    (True, True)
+    """
+    df.to_csv(out, sep="\t", header=header, date_format=DATE_FORMAT)
+
+def _values(df):
+    for c in df.columns:
+        if df[c].dtype != np.float64 and df[c].dtype != np.int64:
+            raise ValueError("unexpected column type: %s" % df[c].dtype)
+    return df.to_numpy(dtype=np.float64)
+
+def _monotonic_increasing(values, last):
+    """
+    per column: are the non-null values of values (rows x columns) increasing
+    and not smaller than last? Returns the result and the new last values
+    """
+    if len(values) == 0:
+        return np.ones(len(last), dtype=bool), last
+    with np.errstate(invalid="ignore"):
+        # comparisons with nulls are False, so this only sees decreasing
+        # neighbours; columns with nulls in between are checked again
+        monotonic = ~((values[1:] < values[:-1]).any(axis=0) | (values[0] < last))
+        nulls = np.flatnonzero(monotonic & np.isnan(values).any(axis=0))
+        if len(nulls) > 0:
+            # a value is not smaller than all values before it, iff it
+            # equals their running maximum (fmax skips nulls)
+            subset = values[:, nulls]
+            running_max = np.fmax(np.fmax.accumulate(subset, axis=0), last[nulls])
+            monotonic[nulls] = ~(subset < running_max).any(axis=0)
+    return monotonic, np.fmax(last, np.fmax.reduce(values, axis=0))
+
+def _classify(columns, rows, count, constant, zscore_var, monotonic):
     classes = {
       "empty_fields": [],
       "constant_fields": [],
@@ -31,31 +89,160 @@ def classify_series(df):
       "monotonic_fields": [],
       "other_fields": [],
     }
-    for c in df.columns:
-        column = df[c].dropna()
-        if len(column) == 0:
+    for i, c in enumerate(columns):
+        if count[i] == 0:
             key = "empty_fields"
-        elif len(column)/len(df[c]) <= 0.002:
+        elif count[i]/rows <= 0.002:
             key = "low_frequency"
-        elif column.var() == 0:
+        elif constant[i]:
             key = "constant_fields"
-        elif zscore(column).var() <= 1e-2:
+        elif zscore_var[i] <= 1e-2:
             key = "low_variance_fields"
-        elif is_monotonic(column):
+        elif monotonic[i]:
             key = "monotonic_fields"
         else:
             key = "other_fields"
         classes[key].append(c)
     return classes
 
-def interpolate_missing(df, sampling_rate):
-    df = df.resample("500ms").mean()
-    cols = {}
-    for col in df.columns:
-        cols[col] = df[col].interpolate(method="spline", limit=2 * int(1/sampling_rate), order=3)
-    df2 = pd.DataFrame(cols)
+def classify_series(df):
+    """
+    sort the columns of df into empty, low frequency, constant, low variance,
+    monotonic and other fields. All columns are handled at once on the
+    (samples x columns) array, null values are ignored.
+    """
+    values = _values(df)
+    valid = ~np.isnan(values)
+    count = valid.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(valid, values, 0).sum(axis=0) / count
+        deviation = np.where(valid, values - mean, 0)
+        squares = np.einsum("ij,ij->j", deviation, deviation)
+        var = squares / (count - 1)
+        # zscore(column).var(): the z-scores are the deviations divided by
+        # sqrt(squares / count), their variance is 1 unless the deviations
+        # do not average to 0 because of rounding. Zero variance gives nan,
+        # which zscore turns into 0.
+        offset = deviation.sum(axis=0) / count
+        zscore_var = np.nan_to_num(1 - offset ** 2 / (squares / count), nan=0.0)
+    # columns with a single distinct value are constant, even if the rounded
+    # mean makes their variance slightly positive
+    constant = (var == 0) | (np.fmin.reduce(values, axis=0) == np.fmax.reduce(values, axis=0))
+    monotonic, _ = _monotonic_increasing(values, np.full(len(df.columns), -np.inf))
+    return _classify(df.columns, len(df), count, constant, zscore_var, monotonic)
+
+INTERPOLATION_METHODS = ["spline", "linear", "pchip"]
+
+def interpolate_missing(df, sampling_rate, method="spline"):
+    return fill_missing(df.resample(RESAMPLE_INTERVAL).mean(), sampling_rate, method)
+
+def fill_missing(df, sampling_rate, method="spline"):
+    """
+    fill up to 2/sampling_rate missing values after each value, the rest
+    with 0. method is one of INTERPOLATION_METHODS: "spline" fits a cubic
+    spline per column, "linear" and "pchip" fill all columns at once.
+    """
+    limit = 2 * int(1/sampling_rate)
+    if method == "spline":
+        cols = {}
+        for col in df.columns:
+            cols[col] = df[col].interpolate(method="spline", limit=limit, order=3)
+        df2 = pd.DataFrame(cols)
+    elif method in ["linear", "pchip"]:
+        values = fill_gaps(df.to_numpy(dtype=np.float64), limit, method)
+        df2 = pd.DataFrame(values, index=df.index, columns=df.columns)
+    else:
+        raise ValueError("unknown interpolation method: %s" % method)
     return df2.fillna(value=0)
 
+def _neighbours(valid):
+    """
+    for every row and column of valid: the last valid row up to it (-1 if
+    none) and the first valid row from it on (len(valid) if none)
+    """
+    rows = np.arange(len(valid))[:, None]
+    before = np.where(valid, rows, -1)
+    np.maximum.accumulate(before, axis=0, out=before)
+    after = np.where(valid, rows, len(valid))[::-1]
+    after = np.minimum.accumulate(after, axis=0)[::-1]
+    return before, after
+
+def _pchip_slopes(values, before, after, knots, cols):
+    """
+    derivatives of scipy's PchipInterpolator at the valid rows knots of the
+    columns cols, from the neighbouring valid rows
+    """
+    n = len(values)
+    a = np.where(knots > 0, before[np.maximum(knots - 1, 0), cols], -1)
+    b = np.where(knots < n - 1, after[np.minimum(knots + 1, n - 1), cols], n)
+    has_a = a >= 0
+    has_b = b < n
+    a2 = np.where(has_a & (a > 0), before[np.maximum(a - 1, 0), cols], -1)
+    b2 = np.where(has_b & (b < n - 1), after[np.minimum(b + 1, n - 1), cols], n)
+    y = values[knots, cols]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        h_a = knots - a
+        h_b = b - knots
+        m_a = (y - values[np.clip(a, 0, n - 1), cols]) / h_a
+        m_b = (values[np.clip(b, 0, n - 1), cols] - y) / h_b
+        # interior knots: weighted harmonic mean of the secants
+        w1 = 2 * h_b + h_a
+        w2 = h_b + 2 * h_a
+        interior = (w1 + w2) / (w1 / m_a + w2 / m_b)
+        interior[(np.sign(m_a) != np.sign(m_b)) | (m_a == 0) | (m_b == 0)] = 0
+        # end knots: one sided three point estimate
+        def edge(h0, h1, m0, m1):
+            d = ((2 * h0 + h1) * m0 - h0 * m1) / (h0 + h1)
+            clip = (np.sign(m0) != np.sign(m1)) & (np.abs(d) > 3 * np.abs(m0))
+            return np.where(np.sign(d) != np.sign(m0), 0, np.where(clip, 3 * m0, d))
+        m_a2 = (values[np.clip(a, 0, n - 1), cols] - values[np.clip(a2, 0, n - 1), cols]) / (a - a2)
+        m_b2 = (values[np.clip(b2, 0, n - 1), cols] - values[np.clip(b, 0, n - 1), cols]) / (b2 - b)
+        first = np.where(b2 < n, edge(h_b, b2 - b, m_b, m_b2), m_b)
+        last = np.where(a2 >= 0, edge(h_a, a - a2, m_a, m_a2), m_a)
+    return np.select([has_a & has_b, has_b, has_a], [interior, first, last], 0)
+
+def fill_gaps(values, limit, method="linear"):
+    """
+    like Series.interpolate(method, limit=limit) for every column of values
+    (samples x columns, equally spaced) at once: up to limit nulls after a
+    value are filled, nulls after the last value are extrapolated
+    """
+    values = np.array(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    before, after = _neighbours(valid)
+    rows = np.arange(len(values))[:, None]
+    rows, cols = np.nonzero(~valid & (before >= 0) & (rows - before <= limit))
+    p = before[rows, cols]
+    q = after[rows, cols]
+    trailing = q == len(values)
+    if method == "linear":
+        # np.interp keeps the last value after the end
+        q = np.where(trailing, p, q)
+        y_p = values[p, cols]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            t = np.where(trailing, 0, (rows - p) / (q - p))
+        values[rows, cols] = y_p + t * (values[q, cols] - y_p)
+    elif method == "pchip":
+        # after the end the last piece is extrapolated
+        p_before = np.where(p > 0, before[np.maximum(p - 1, 0), cols], -1)
+        single = trailing & (p_before < 0)
+        p, q = np.where(trailing & ~single, p_before, p), np.where(trailing, p, q)
+        y_p = values[p, cols]
+        y_q = values[q, cols]
+        d_p = _pchip_slopes(values, before, after, p, cols)
+        d_q = _pchip_slopes(values, before, after, q, cols)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            h = q - p
+            t = (rows - p) / h
+            t2 = t * t
+            t3 = t2 * t
+            filled = ((2 * t3 - 3 * t2 + 1) * y_p + (t3 - 2 * t2 + t) * h * d_p +
+                      (-2 * t3 + 3 * t2) * y_q + (t3 - t2) * h * d_q)
+        values[rows, cols] = np.where(single, y_p, filled)
+    else:
+        raise ValueError("unknown interpolation method: %s" % method)
+    return values
+
 def diff(df, monotonic_fields):
     montonic = set(monotonic_fields)
     series = {}
@@ -66,33 +253,366 @@ def diff(df, monotonic_fields):
             series[c] = df[c][1:]
     return pd.DataFrame(series)
 
-def apply(path, sampling_rate):
-    data = metadata.load(path)
-    for service in data["services"]:
-        filename = os.path.join(path, service["filename"])
-        newname = service["name"] + "-preprocessed.tsv.gz"
-        service["preprocessed_filename"] = newname
-        newpath = os.path.join(path, newname)
-        if os.path.exists(newpath) and "other_fields" in service:
-            print("skip %s" % newpath)
-            #continue
+def raw_chunks(filename, service, chunksize, skip=0):
+    """
+    raw measurement in chunks of chunksize rows, restricted to the fields of
+    the service (and the cpu tag). The first skip rows after the header are
+    only decompressed and split into lines, not parsed.
+    """
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, "rb") as f:
+        header = f.readline()
+        for _ in itertools.islice(f, skip):
+            pass
+        columns = list(pd.read_csv(io.BytesIO(header), sep="\t", nrows=0).columns)
+        usecols = ["time"] + service["fields"]
+        if "cpu" in columns:
+            usecols.append("cpu")
+        yield from pd.read_csv(f, sep="\t", header=None, names=columns, index_col='time',
+                               parse_dates=True, usecols=usecols, chunksize=chunksize)
+
+def cpu_total(df, service):
+    if "cpu" in df:
+        # rows without a cpu tag are kept, so this is the same as
+        # load_timeseries' filter for any chunk
+        df = df[df["cpu"].isnull() | (df["cpu"] == "cpu-total")]
+    return df[service["fields"]]
+
+def read_chunks(filename, service, chunksize):
+    """
+    raw measurement in chunks of chunksize rows, restricted to the fields of
+    the service and filtered like load_timeseries
+    """
+    for df in raw_chunks(filename, service, chunksize):
+        yield cpu_total(df, service)
+
+class FieldStats():
+    """
+    per column statistics of classify_series, accumulated chunk by chunk
+    """
+    def __init__(self, columns):
+        self.columns = list(columns)
+        n = len(self.columns)
+        self.rows = 0
+        self.count = np.zeros(n)
+        self.mean = np.zeros(n)
+        self.m2 = np.zeros(n)
+        self.min = np.full(n, np.inf)
+        self.max = np.full(n, -np.inf)
+        self.last = np.full(n, -np.inf)
+        self.monotonic = np.ones(n, dtype=bool)
+        self.first_time = None
+        self.last_time = None
+
+    def update(self, df):
+        if len(df) == 0:
+            return
+        if self.last_time is not None and df.index[0] < self.last_time or not df.index.is_monotonic_increasing:
+            raise ValueError("streaming preprocess needs a file sorted by time")
+        if self.first_time is None:
+            self.first_time = df.index[0]
+        self.last_time = df.index[-1]
+        values = _values(df)
+        valid = ~np.isnan(values)
+        self.rows += len(values)
+
+        # merge mean and sum of squared deviations (Chan et al.)
+        count = valid.sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.nansum(values, axis=0) / count
+            m2 = np.nansum((values - mean) ** 2, axis=0)
+        has = count > 0
+        total = self.count + count
+        delta = np.where(has, mean - self.mean, 0)
+        self.mean = np.where(has, self.mean + delta * np.where(has, count / np.maximum(total, 1), 0), self.mean)
+        self.m2 = np.where(has, self.m2 + m2 + delta ** 2 * self.count * count / np.maximum(total, 1), self.m2)
+        self.count = total
+        self.min = np.fmin(self.min, np.nanmin(np.where(valid, values, np.inf), axis=0))
+        self.max = np.fmax(self.max, np.nanmax(np.where(valid, values, -np.inf), axis=0))
+
+        # continues from the last non-null value of the previous chunk
+        monotonic, self.last = _monotonic_increasing(values, self.last)
+        self.monotonic &= monotonic
+
+    def classes(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            # variance of the z-scored values, see zscore
+            var = self.m2 / self.count
+            zscore_var = np.nan_to_num(var / np.sqrt(var) ** 2)
+        return _classify(self.columns, self.rows, self.count, self.min == self.max, zscore_var, self.monotonic)
+
+    def resampled_index(self):
+        """
+        index of interpolate_missing's result for the whole file
+        """
+        if self.first_time is None:
+            return pd.DatetimeIndex([], name="time")
+        return pd.date_range(self.first_time.floor(RESAMPLE_INTERVAL),
+                             self.last_time.floor(RESAMPLE_INTERVAL),
+                             freq=RESAMPLE_INTERVAL, name="time")
+
+def resample_chunks(chunks):
+    """
+    resample chunks like interpolate_missing does: the rows of the last bin
+    of a chunk are carried over to the next chunk, so no bin is split
+    """
+    carry = None
+    for df in chunks:
+        if carry is not None:
+            df = pd.concat([carry, df])
+        if len(df) == 0:
+            continue
+        resampled = df.resample(RESAMPLE_INTERVAL).mean()
+        last_bin = resampled.index[-1]
+        carry = df[df.index >= last_bin]
+        if len(resampled) > 1:
+            yield resampled.iloc[:-1]
+    if carry is not None and len(carry) > 0:
+        yield carry.resample(RESAMPLE_INTERVAL).mean()
+
+def fill_chunks(chunks, sampling_rate, overlap, method="spline"):
+    """
+    fill_missing for resampled chunks; rows are interpolated together with
+    overlap bins before and after them, so gaps at chunk boundaries are
+    filled from both sides
+    """
+    before = None
+    queue = None
+    for df in chunks:
+        queue = df if queue is None else pd.concat([queue, df])
+        if len(queue) > overlap:
+            # hold back overlap bins as look ahead for the next rows
+            core = queue.iloc[:len(queue) - overlap]
+            window = pd.concat([x for x in [before, queue] if x is not None])
+            yield fill_missing(window, sampling_rate, method).loc[core.index]
+            before = pd.concat([x for x in [before, core] if x is not None]).iloc[-overlap:]
+            queue = queue.iloc[len(queue) - overlap:]
+    if queue is not None and len(queue) > 0:
+        window = pd.concat([x for x in [before, queue] if x is not None])
+        yield fill_missing(window, sampling_rate, method).loc[queue.index]
+
+def diff_chunks(chunks, monotonic_fields):
+    """
+    diff for consecutive chunks, the first row of the whole series is dropped
+    """
+    previous = None
+    for df in chunks:
+        if previous is not None:
+            df = pd.concat([previous, df])
+        previous = df.iloc[-1:]
+        yield diff(df, monotonic_fields)
+
+def apply_streaming(filename, newpath, service, sampling_rate, chunksize, overlap=120, method="spline"):
+    """
+    preprocess a raw measurement that does not fit into memory in two passes
+    over chunks of chunksize rows: the first one classifies the fields, the
+    second resamples, interpolates and diffs the kept fields and writes the
+    tsv and the store as it goes. The "spline" method is fitted per chunk
+    (plus overlap bins on both sides) instead of over the whole series, so
+    filled gaps can differ slightly from apply without chunksize; "linear"
+    and "pchip" only look at neighbouring values and give the same result.
+    """
+    stats = FieldStats(service["fields"])
+    for df in read_chunks(filename, service, chunksize):
+        stats.update(df)
+    classes = stats.classes()
+    fields = classes["other_fields"] + classes["monotonic_fields"]
+    montonic = set(classes["monotonic_fields"])
+    columns = [c + "-diff" if c in montonic else c for c in fields]
+    index = stats.resampled_index()[1:]
+
+    chunks = (df[fields] for df in read_chunks(filename, service, chunksize))
+    chunks = resample_chunks(chunks)
+    chunks = fill_chunks(chunks, sampling_rate, overlap, method)
+    chunks = diff_chunks(chunks, classes["monotonic_fields"])
+    with store.writer(newpath, index, columns) as matrix:
+        with _atomic_write(newpath, mode="w+b") as f:
+            with gzip.open(f, "wt") as out:
+                write_tsv(pd.DataFrame(columns=columns, index=index[:0]), out)
+                row = 0
+                for df in chunks:
+                    if row + len(df) > len(index) or not (df.index == index[row:row + len(df)]).all():
+                        raise ValueError("%s: resampled chunks do not match the time range of the file" % filename)
+                    write_tsv(df, out, header=False)
+                    matrix[row:row + len(df)] = df[columns].values
+                    row += len(df)
+                if row != len(index):
+                    raise ValueError("%s: expected %d rows, got %d" % (filename, len(index), row))
+    return columns, classes, stats.last_time
+
+def is_preprocessed(path, service):
+    """
+    True if the preprocessed file of service was committed to the metadata
+    and is not older than the raw measurement
+    """
+    if "other_fields" not in service or "preprocessed_filename" not in service:
+        return False
+    newpath = os.path.join(path, service["preprocessed_filename"])
+    filename = os.path.join(path, service["filename"])
+    return os.path.exists(newpath) and os.path.getmtime(newpath) >= os.path.getmtime(filename)
+
+def process_service(path, service, sampling_rate, chunksize=None, method="spline"):
+    """
+    preprocess a single service and commit its classes and fields to the
+    metadata, so finished services survive a crash of later ones
+    """
+    filename = os.path.join(path, service["filename"])
+    newname = service["name"] + "-preprocessed.tsv.gz"
+    newpath = os.path.join(path, newname)
+    if chunksize is not None:
+        columns, classes, until = apply_streaming(filename, newpath, service, sampling_rate, chunksize, method=method)
+    else:
         df = load_timeseries(filename, service)
         classes = classify_series(df)
-        preprocessed_series = {}
-        df2 = interpolate_missing(df[classes["other_fields"] + classes["monotonic_fields"]], sampling_rate)
+        df2 = interpolate_missing(df[classes["other_fields"] + classes["monotonic_fields"]], sampling_rate, method)
         df3 = diff(df2, classes["monotonic_fields"])
-        df3.to_csv(newpath, sep="\t", compression='gzip')
-        service["preprocessed_fields"] = list(df3.columns)
-        service.update(classes)
-    metadata.save(path, data)
+        with gzip.open(newpath, "wt") as out:
+            write_tsv(df3, out)
+        store.write(newpath, df3)
+        columns = list(df3.columns)
+        until = df.index[-1] if len(df) > 0 else None
+    sbdcache.invalidate(path, service)
+    with metadata.update(path) as data:
+        for srv in data["services"]:
+            if srv["name"] == service["name"]:
+                srv["preprocessed_filename"] = newname
+                srv["preprocessed_fields"] = columns
+                srv["preprocessed_until"] = None if until is None else str(until)
+                srv.pop("preprocessed_skip_rows", None)
+                srv["interpolation"] = method
+                srv.update(classes)
+    print(newpath)
+
+def _tail_start(until, overlap):
+    """
+    first recomputed bin and first context sample of append_service
+    """
+    interval = pd.Timedelta(RESAMPLE_INTERVAL)
+    recompute = until.floor(RESAMPLE_INTERVAL) - overlap * interval
+    return recompute, recompute - overlap * interval
+
+def append_service(path, service, sampling_rate, chunksize=None, method="spline", overlap=120):
+    """
+    preprocess only the raw samples after the preprocessed_until timestamp of
+    service and replace the tail of its preprocessed file and store with
+    them. The last overlap bins before that timestamp are computed again
+    (the last bin may get more samples, gaps before the end are now filled
+    from both sides) with another overlap bins of context before them, so
+    the result matches a full run for the linear and pchip methods. The
+    classes of the fields are kept from the full run.
+
+    The raw rows before the context of the next run are counted in
+    preprocessed_skip_rows, the next run only scans them for line ends
+    instead of parsing them. This assumes raw measurements are only
+    appended to. The first incremental run after a full one still parses
+    the whole file.
+    """
+    filename = os.path.join(path, service["filename"])
+    newpath = os.path.join(path, service["preprocessed_filename"])
+    until = pd.Timestamp(service["preprocessed_until"])
+    recompute, context = _tail_start(until, overlap)
+    fields = service["other_fields"] + service["monotonic_fields"]
+    skip = service.get("preprocessed_skip_rows", 0)
+
+    last = None
+    # raw timestamps, to count the rows the next run can skip
+    times = []
+    def tail():
+        nonlocal last
+        for df in raw_chunks(filename, service, chunksize or 100000, skip):
+            times.append(df.index)
+            df = cpu_total(df, service)
+            if len(df) > 0:
+                last = df.index[-1]
+            yield df[df.index >= context][fields]
+    chunks = resample_chunks(tail())
+    chunks = fill_chunks(chunks, sampling_rate, overlap, method)
+    chunks = diff_chunks(chunks, service["monotonic_fields"])
+    new = [df[df.index >= recompute] for df in chunks]
+    if last is None or last <= until:
+        print("%s is up to date" % newpath)
+        return
+    new = pd.concat(new)
+    if list(new.columns) != service["preprocessed_fields"]:
+        raise ValueError("%s: columns changed, preprocess it again with --force" % newpath)
+
+    if not store.exists(newpath):
+        store.write(newpath, pd.read_csv(newpath, sep="\t", index_col='time', parse_dates=True))
+    index = store.read_matrix(newpath)[1]
+    start = index.searchsorted(new.index[0])
+    # keep the first start rows of the tsv as they are
+    with _atomic_write(newpath, mode="w+b") as f:
+        with gzip.open(f, "wt") as out, gzip.open(newpath, "rt") as old:
+            out.write(old.readline())
+            for _ in range(start):
+                out.write(old.readline())
+            write_tsv(new, out, header=False)
+    store.replace_tail(newpath, start, new)
+    sbdcache.invalidate(path, service)
+    next_context = _tail_start(last, overlap)[1]
+    with metadata.update(path) as data:
+        for srv in data["services"]:
+            if srv["name"] == service["name"]:
+                srv["preprocessed_until"] = str(last)
+                srv["preprocessed_skip_rows"] = skip + sum(int(t.searchsorted(next_context)) for t in times)
+    print("%s: %d new rows" % (newpath, start + len(new) - len(index)))
+
+def _process_service(args):
+    func, args = args[0], args[1:]
+    try:
+        func(*args)
+        return args[1]["name"], None
+    except Exception:
+        return args[1]["name"], traceback.format_exc()
+    finally:
+        # the pool terminates its workers, a write-behind journal would be lost
+        metadata.flush()
+
+def apply(path, sampling_rate, chunksize=None, method="spline", jobs=1, force=False, incremental=False):
+    """
+    preprocess all services of a measurement, that are not preprocessed yet
+    (or all with force). With incremental, services preprocessed before only
+    get the samples added to the raw measurement since then (append_service).
+    With jobs > 1 the services are processed on a process pool; a failed
+    service is reported and does not stop the others.
+    """
+    tasks = []
+    for service in metadata.load(path)["services"]:
+        if not force and is_preprocessed(path, service):
+            print("skip %s" % os.path.join(path, service["preprocessed_filename"]))
+            continue
+        if not force and incremental and service.get("preprocessed_until") is not None:
+            if service.get("interpolation", "spline") != method:
+                raise ValueError("%s was preprocessed with %s interpolation, not %s" %
+                                 (service["name"], service.get("interpolation", "spline"), method))
+            tasks.append((append_service, path, service, sampling_rate, chunksize, method))
+        else:
+            tasks.append((process_service, path, service, sampling_rate, chunksize, method))
+    if jobs <= 1:
+        for task in tasks:
+            task[0](*task[1:])
+        return
+    failed = []
+    with Pool(jobs) as pool:
+        for name, error in pool.imap_unordered(_process_service, tasks):
+            if error is not None:
+                sys.stderr.write("preprocessing %s of %s failed:\n%s" % (name, path, error))
+                failed.append(name)
+    if len(failed) > 0:
+        raise RuntimeError("preprocessing failed for %s in %s" % (", ".join(failed), path))
 
 def parse_args():
     parser = argparse.ArgumentParser(usage='%(prog)s [options]')
     parser.add_argument('measurements', nargs='+', help="measurement directories to process")
     parser.add_argument('--sampling-rate', action='store_true', default=(1/2), help="how often data is updated per second")
+    parser.add_argument('--interpolation', choices=INTERPOLATION_METHODS, default="spline", help="how gaps in the resampled metrics are filled")
+    parser.add_argument('--jobs', type=int, default=1, help="number of services to preprocess in parallel")
+    parser.add_argument('--force', action='store_true', help="preprocess services again, that are already preprocessed")
+    parser.add_argument('--incremental', action='store_true', help="only preprocess samples added to the raw measurements since the last run")
+    parser.add_argument('--chunksize', type=int, help="stream the raw measurements in chunks of this many rows instead of loading them at once")
     return parser.parse_args()
 
 if __name__ == '__main__':
     args = parse_args()
     for p in args.measurements:
-        apply(p, args.sampling_rate)
+        apply(p, args.sampling_rate, args.chunksize, args.interpolation, args.jobs, args.force, args.incremental)
@@ -0,0 +1,69 @@
+"""
+persistent cache of the pairwise sbd (and lag) matrix of a service
+
+The matrices are stored as .npy next to the measurement and memory-mapped on
+load. The cache key is a hash of the preprocessed file content and the
+selected columns, so a rewritten input never matches an old entry.
+"""
+import os
+import glob
+import hashlib
+
+import numpy as np
+
+from kshape import zscore, sbd_distances
+from metadata import _atomic_write
+import loader
+
+def content_hash(filename, columns):
+    h = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    for c in columns:
+        h.update(b"\0" + c.encode("utf-8"))
+    return h.hexdigest()[:16]
+
+def _cache_path(path, service, kind, key):
+    return os.path.join(path, "%s-%s-%s.npy" % (service["name"], kind, key))
+
+def _save(filename, matrix):
+    with _atomic_write(filename, mode="w+b") as f:
+        np.save(f, matrix)
+
+def load(path, service, columns=None, lags=False):
+    """
+    pairwise sbd matrix of the preprocessed columns of a service in the order
+    of columns (default: all preprocessed fields). With lags=True the lag
+    matrix is returned as well: (distances, lags)
+    """
+    filename = os.path.join(path, service["preprocessed_filename"])
+    if columns is None:
+        columns = service["preprocessed_fields"]
+    key = content_hash(filename, columns)
+    sbd_path = _cache_path(path, service, "sbd", key)
+    lag_path = _cache_path(path, service, "lag", key)
+
+    if not os.path.exists(sbd_path) or (lags and not os.path.exists(lag_path)):
+        df = loader.preprocessed(filename)
+        matrix = np.array([zscore(df[c]) for c in columns])
+        if lags:
+            distances, lag_matrix = sbd_distances(matrix, return_lags=True)
+            _save(lag_path, lag_matrix)
+        else:
+            distances = sbd_distances(matrix)
+        _save(sbd_path, distances)
+
+    distances = np.load(sbd_path, mmap_mode="r")
+    if lags:
+        return distances, np.load(lag_path, mmap_mode="r")
+    return distances
+
+def invalidate(path, service):
+    """
+    remove all cached matrices of a service, i.e. after rewriting its input
+    """
+    for kind in ["sbd", "lag"]:
+        pattern = os.path.join(path, "%s-%s-*.npy" % (service["name"], kind))
+        for filename in glob.glob(pattern):
+            os.remove(filename)
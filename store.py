@@ -0,0 +1,141 @@
+"""
+binary columnar store next to the preprocessed tsv files
+
+For <name>.tsv.gz the samples x metrics matrix is stored as <name>.npy, the
+timestamps as int64 nanoseconds in <name>.time.npy and the column names in
+<name>.json. The json is written last, so its presence marks a complete
+store. Readers memory-map the matrix and fall back to the tsv for
+measurements that were preprocessed before the store existed.
+"""
+import os
+import sys
+import json
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+import metadata
+from metadata import _atomic_write
+
+def _base(filename):
+    for suffix in [".tsv.gz", ".tsv"]:
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+def _write_index(base, index, columns):
+    tz = None
+    if getattr(index, "tz", None) is not None:
+        tz = str(index.tz)
+        index = index.tz_convert("UTC").tz_localize(None)
+    times = index.values.astype("datetime64[ns]").view(np.int64)
+    with _atomic_write(base + ".time.npy", mode="w+b") as f:
+        np.save(f, times)
+    with _atomic_write(base + ".json") as f:
+        json.dump(dict(columns=list(columns), index_name=index.name, tz=tz), f)
+
+def write(filename, df):
+    """
+    write df (time indexed, numeric columns) as store next to the tsv filename
+    """
+    base = _base(filename)
+    with _atomic_write(base + ".npy", mode="w+b") as f:
+        np.save(f, np.ascontiguousarray(df.values, dtype=np.float64))
+    _write_index(base, df.index, df.columns)
+
+@contextmanager
+def writer(filename, index, columns):
+    """
+    memory-mapped (len(index), len(columns)) matrix of a new store, to be
+    filled by the caller while the tsv is written. The store is only
+    committed if the block finishes without an exception.
+    """
+    base = _base(filename)
+    tmp = tempfile.NamedTemporaryFile(delete=False, dir=os.path.dirname(base) or ".", suffix=".npy")
+    tmp.close()
+    try:
+        matrix = np.lib.format.open_memmap(tmp.name, mode="w+", dtype=np.float64,
+                                           shape=(len(index), len(columns)))
+        yield matrix
+        matrix.flush()
+        del matrix
+        os.rename(tmp.name, base + ".npy")
+        _write_index(base, index, columns)
+    finally:
+        if os.path.exists(tmp.name):
+            os.remove(tmp.name)
+
+def replace_tail(filename, start, df):
+    """
+    replace the rows from position start on with df (same columns) and
+    extend the store if df reaches further. The matrix is rewritten to a new
+    file and renamed over the old one, so readers that still have the old
+    matrix memory-mapped keep seeing it unchanged.
+    """
+    matrix, index, columns = read_matrix(filename)
+    if list(df.columns) != list(columns):
+        raise ValueError("%s: columns of the new rows do not match the store" % filename)
+    start = int(start)
+    new_index = index[:start].append(df.index)
+    os.remove(_base(filename) + ".json")
+    with writer(filename, new_index, columns) as new:
+        new[:start] = matrix[:start]
+        new[start:] = np.asarray(df.values, dtype=np.float64)
+    del matrix
+
+def exists(filename):
+    """
+    True if filename has a store that is not older than the tsv itself
+    """
+    index_file = _base(filename) + ".json"
+    if not os.path.exists(index_file):
+        return False
+    if not os.path.exists(filename):
+        return True
+    return os.path.getmtime(index_file) >= os.path.getmtime(filename)
+
+def read_matrix(filename, mmap_mode="r"):
+    """
+    (matrix, index, columns) of the store of filename, the matrix memory-mapped
+    """
+    base = _base(filename)
+    with open(base + ".json") as f:
+        info = json.load(f)
+    matrix = np.load(base + ".npy", mmap_mode=mmap_mode)
+    times = np.load(base + ".time.npy").view("datetime64[ns]")
+    index = pd.DatetimeIndex(times, name=info["index_name"])
+    if info["tz"] is not None:
+        index = index.tz_localize("UTC").tz_convert(info["tz"])
+    return matrix, index, info["columns"]
+
+def read(filename):
+    """
+    time indexed DataFrame of a preprocessed file, from the store if possible
+    """
+    if not exists(filename):
+        return pd.read_csv(filename, sep="\t", index_col='time', parse_dates=True)
+    matrix, index, columns = read_matrix(filename)
+    return pd.DataFrame(matrix, index=index, columns=columns, copy=False)
+
+def convert(path):
+    """
+    create the store for all preprocessed files of an existing measurement
+    """
+    for srv in metadata.load(path)["services"]:
+        if "preprocessed_filename" not in srv:
+            continue
+        filename = os.path.join(path, srv["preprocessed_filename"])
+        if exists(filename):
+            print("skip %s" % filename)
+            continue
+        print(filename)
+        write(filename, pd.read_csv(filename, sep="\t", index_col='time', parse_dates=True))
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.stderr.write("USAGE: %s measurement...\n" % sys.argv[0])
+        sys.exit(1)
+    for arg in sys.argv[1:]:
+        convert(arg)
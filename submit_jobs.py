@@ -18,13 +18,17 @@ def _cluster_service(args):
     import cluster
     return cluster.cluster_service(*args)
 
+def _cluster_service_sweep(args):
+    import cluster
+    return cluster.cluster_service_sweep(*args)
+
 def cluster_services(path):
     data = metadata.load(path)
     ids = []
-    for cluster_size in range(1, 8):
-        for service in data["services"]:
-            res = lview.apply_async(_cluster_service, (path, service, cluster_size))
-            ids.extend(res.msg_ids)
+    # one job per service, the cluster sizes warm start each other
+    for service in data["services"]:
+        res = lview.apply_async(_cluster_service_sweep, (path, service, list(range(1, 8))))
+        ids.extend(res.msg_ids)
     return ids
 
 
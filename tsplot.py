@@ -1,5 +1,6 @@
 import os, sys
 import metadata
+import loader
 import pandas as pd
 import numpy as np
 import random
@@ -11,11 +12,11 @@ from plot import plt, sns
 
 def draw(path, srv):
      filename = os.path.join(path, srv["preprocessed_filename"])
-     df = pd.read_csv(filename, sep="\t", index_col='time', parse_dates=True)
+     df = loader.preprocessed(filename)
      bins = defaultdict(list)
      for i, col in enumerate(df.columns):
          serie = df[col].dropna()
-         if pd.algos.is_monotonic_float64(serie.values, False)[0]:
+         if serie.is_monotonic_increasing:
              serie = serie.diff()[1:]
          p_value = adfuller(serie, autolag='AIC')[1]
          if math.isnan(p_value): continue
@@ -40,6 +41,6 @@ if __name__ == '__main__':
         sys.stderr.write("USAGE: %s measurment\n" % sys.argv[0])
         sys.exit(1)
     for path in sys.argv[1:]:
-        services = metadata.load(path)["services"]
+        services = loader.metadata(path)["services"]
         for srv in services:
             draw(path, srv)